@@ -0,0 +1,50 @@
+import numpy as np
+
+class AudioBuffer():
+    """
+    Store of audio samples appended in place into a preallocated (growable) array.
+    Samples are addressed with absolute positions (counted since the beginning of the stream), those before the released position are discarded:
+    memory only depends on the amount of samples not yet released, and appending a block does not copy the previous samples.
+    """
+    def __init__(self, capacity=16000*30, dtype=np.float32):
+        self.data = np.empty(max(capacity, 1), dtype=dtype)
+        self.offset = 0 ### absolute position of self.data[0]
+        self.size = 0   ### number of samples currently stored in self.data
+
+    def __len__(self):
+        """ absolute position of the end of the stream (number of samples appended so far) """
+        return self.offset + self.size
+
+    def __getitem__(self, s):
+        """
+        Returns a view of the samples in the absolute slice s (samples must not be released).
+        The view may be overwritten by later calls to append/release, copy it if it is used outside the lock protecting the buffer.
+        """
+        if not isinstance(s, slice) or s.step not in (None, 1):
+            raise TypeError('AudioBuffer only supports contiguous slices')
+        start = self.offset if s.start is None else s.start
+        stop = len(self) if s.stop is None else min(s.stop, len(self))
+        if start < self.offset:
+            raise IndexError('samples before {} were released (requested {})'.format(self.offset, start))
+        return self.data[start-self.offset:max(stop, start)-self.offset]
+
+    def append(self, samples):
+        n = len(samples)
+        if self.size + n > len(self.data):
+            capacity = len(self.data)
+            while capacity < self.size + n:
+                capacity *= 2
+            data = np.empty(capacity, dtype=self.data.dtype)
+            data[:self.size] = self.data[:self.size]
+            self.data = data
+        self.data[self.size:self.size+n] = samples
+        self.size += n
+
+    def release(self, position):
+        """ discard samples before the absolute position (moves the remaining ones to the beginning of the array) """
+        k = min(position, len(self)) - self.offset
+        if k <= 0:
+            return
+        self.data[:self.size-k] = self.data[k:self.size]
+        self.offset += k
+        self.size -= k
@@ -0,0 +1,121 @@
+import time
+import queue
+import logging
+import threading
+from Metrics import Counter, Gauge, Histogram, SIZE_BUCKETS
+from Serving import cancel_event, Cancelled
+
+queue_depth = Gauge('batcher_queue_depth', 'requests waiting to be batched')
+queue_seconds = Histogram('batcher_queue_seconds', 'time (seconds) requests wait until their batch is processed')
+batch_items = Histogram('batcher_batch_items', 'items processed by a call of the batched function', buckets=SIZE_BUCKETS)
+batch_seconds = Histogram('batcher_batch_seconds', 'duration (seconds) of the calls of the batched function')
+batch_errors = Counter('batcher_batch_errors_total', 'calls of the batched function that raised an exception')
+batch_cancelled = Counter('batcher_cancelled_total', 'requests dropped before being processed because their client disconnected')
+
+class BatcherFull(Exception):
+    """ raised when the number of requests waiting exceeds max_queue """
+    pass
+
+class Batcher():
+    """
+    Dynamic batching of the requests submitted by concurrent threads (Ex: flask handlers).
+    A scheduler thread gathers the requests arriving within max_wait seconds after the first one (up to max_size items) and
+    processes the items of the requests sharing the same key with a single call to fn(key, items), which returns one result per item.
+    Each request then receives the results of its own items (or the exception raised by fn).
+    - size: function returning the size of an item (Ex: number of tokens) used to fill batches up to max_size
+    - workers: number of scheduler threads (batches processed concurrently)
+    - max_queue: maximum number of requests waiting to be batched (0 for no limit), further requests raise BatcherFull
+    Requests whose client disconnected (see Serving.cancel_event) are dropped when gathered and raise Cancelled.
+    Queue depth, queue wait, batch sizes and durations are exported as batcher_* metrics labelled with the batcher name.
+    """
+    def __init__(self, fn, max_size=8, max_wait=0.01, size=None, workers=1, max_queue=0, name='batcher'):
+        self.fn = fn
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self.size = size if size is not None else (lambda item: 1)
+        self.name = name
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.next = None ### request that did not fit in the previous batch
+        self.lock = threading.Lock() ### one worker gathers a batch at a time
+        queue_depth.set_function(self.queue.qsize, batcher=name)
+        self.workers = 0
+        self.configure(workers=workers)
+
+    def configure(self, max_size=None, max_wait=None, workers=None):
+        """ changes the settings given (Ex: from the command line of a server whose batcher is created at import), scheduler threads are started up to workers """
+        if max_size is not None:
+            self.max_size = max_size
+        if max_wait is not None:
+            self.max_wait = max_wait
+        while workers is not None and self.workers < workers:
+            threading.Thread(target=self.run, name='{}-{}'.format(self.name, self.workers), daemon=True).start()
+            self.workers += 1
+
+    def __call__(self, key, items):
+        r = {'key': key, 'items': items, 'size': sum([self.size(x) for x in items]), 'results': None, 'error': None, 'done': threading.Event(), 'tic': time.time(), 'cancelled': cancel_event()}
+        try:
+            self.queue.put_nowait(r)
+        except queue.Full:
+            raise BatcherFull('{} queue is full ({} requests waiting)'.format(self.name, self.queue.qsize()))
+        r['done'].wait()
+        if r['error'] is not None:
+            raise r['error']
+        return r['results']
+
+    def gather(self):
+        """ returns the list of requests of the next batch """
+        if self.next is not None:
+            batch, self.next = [self.next], None
+        else:
+            batch = [self.queue.get()]
+        size = batch[0]['size']
+        deadline = time.time() + self.max_wait
+        while size < self.max_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                r = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if size + r['size'] > self.max_size:
+                self.next = r
+                break
+            batch.append(r)
+            size += r['size']
+        return batch
+
+    def run(self):
+        while True:
+            with self.lock:
+                batch = self.gather()
+            groups = {}
+            now = time.time()
+            for r in batch:
+                queue_seconds.observe(now - r['tic'], batcher=self.name)
+                if r['cancelled'] is not None and r['cancelled'].is_set():
+                    batch_cancelled.inc(batcher=self.name)
+                    r['error'] = Cancelled('client disconnected before the batch was processed')
+                    r['done'].set()
+                    continue
+                groups.setdefault(r['key'], []).append(r)
+            logging.debug('[{}] batch of {} requests in {} groups'.format(self.name, len(batch), len(groups)))
+            for key, reqs in groups.items():
+                try:
+                    items = [x for r in reqs for x in r['items']]
+                    tic = time.time()
+                    results = self.fn(key, items)
+                    batch_items.observe(len(items), batcher=self.name)
+                    batch_seconds.observe(time.time() - tic, batcher=self.name)
+                    i = 0
+                    for r in reqs:
+                        r['results'] = results[i:i+len(r['items'])]
+                        i += len(r['items'])
+                except Exception as e:
+                    logging.exception('[{}] error processing batch'.format(self.name))
+                    batch_errors.inc(batcher=self.name)
+                    for r in reqs:
+                        r['error'] = e
+                finally:
+                    for r in reqs:
+                        r['done'].set()
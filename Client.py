@@ -0,0 +1,165 @@
+import time
+import asyncio
+import logging
+import requests
+import functools
+import threading
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+
+class ClientError(Exception):
+    """ base class of the errors raised by Client """
+    pass
+
+class ConnectError(ClientError):
+    pass
+
+class RequestTimeout(ClientError):
+    pass
+
+class InvalidResponse(ClientError):
+    pass
+
+class HTTPError(ClientError):
+    def __init__(self, status, message):
+        super().__init__('{} {}'.format(status, message))
+        self.status = status
+
+class Client():
+    """
+    HTTP client sharing a pool of persistent (keep-alive) connections to the server url.
+    url is either a server url or a list of urls (or comma-separated string) of server replicas: each request is sent to the healthy replica with the fewest
+    outstanding requests, replicas failing are taken out of rotation until a background health check (every health_interval seconds) finds them answering again.
+    Requests failing with a connection error, a timeout or a 5xx response are retried (on another replica if any) up to retries times, waiting backoff * 2^i seconds before the i-th retry.
+    Errors are raised as ClientError subclasses: ConnectError, RequestTimeout, HTTPError (with status) and InvalidResponse.
+    """
+    def __init__(self, url, timeout=10.0, retries=3, backoff=0.5, pool_size=10, health_interval=5.0):
+        urls = url.split(',') if isinstance(url, str) else list(url)
+        self.url = urls[0]
+        self.replicas = [{'url': u, 'outstanding': 0, 'healthy': True} for u in urls]
+        self.lock = threading.Lock()
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.health_interval = health_interval
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max(pool_size, len(urls)), pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        if len(self.replicas) > 1:
+            threading.Thread(target=self.check_health, name='health', daemon=True).start()
+
+    def choose(self, exclude=()):
+        """ returns the url of the healthy replica (not in exclude if possible) with the fewest outstanding requests """
+        with self.lock:
+            candidates = [r for r in self.replicas if r['url'] not in exclude] or self.replicas
+            candidates = [r for r in candidates if r['healthy']] or candidates
+            return min(candidates, key=lambda r: r['outstanding'])['url']
+
+    def replica(self, url):
+        return next(r for r in self.replicas if r['url'] == url)
+
+    def set_health(self, url, healthy):
+        with self.lock:
+            r = self.replica(url)
+            if r['healthy'] != healthy:
+                logging.warning('replica %s %s', url, 'back in rotation' if healthy else 'out of rotation')
+            r['healthy'] = healthy
+
+    def check_health(self):
+        """ replicas are healthy while they answer (status < 500, or 503: overloaded but alive) GET /health """
+        while True:
+            time.sleep(self.health_interval)
+            for r in list(self.replicas):
+                u = urllib.parse.urlsplit(r['url'])
+                try:
+                    status = self.session.get('{}://{}/health'.format(u.scheme, u.netloc), timeout=min(self.timeout, 2.0)).status_code
+                    healthy = status < 500 or status == 503 ### as in request(): 503 is not a failure of the replica
+                except requests.exceptions.RequestException:
+                    healthy = False
+                self.set_health(r['url'], healthy)
+
+    def request(self, method, path='', not_found=False, stream=False, replica=None, **kwargs):
+        """
+        Sends the request to url + path and returns the json response (None if not_found and the server answers 404).
+        With stream=True returns the (unread) response.
+        replica: send the request to this replica url (Ex: to reach the replica holding a session) rather than choosing one.
+        """
+        tried = []
+        for i in range(self.retries + 1):
+            base = replica if replica is not None else self.choose(exclude=tried)
+            if base in tried:
+                time.sleep(self.backoff * 2**(i-1))
+            tried.append(base)
+            url = base + path
+            with self.lock:
+                self.replica(base)['outstanding'] += 1
+            try:
+                response = self.session.request(method, url, timeout=self.timeout, stream=stream, **kwargs)
+            except requests.exceptions.Timeout as e:
+                logging.warning("%s %s Error (Timeout) attempt %d: %s", method, url, i+1, e)
+                error = RequestTimeout(str(e))
+                self.set_health(base, False)
+                continue
+            except requests.exceptions.ConnectionError as e:
+                logging.warning("%s %s Error (ConnectionError) attempt %d: %s", method, url, i+1, e)
+                error = ConnectError(str(e))
+                self.set_health(base, False)
+                continue
+            except requests.exceptions.RequestException as e:
+                raise ClientError(str(e))
+            finally:
+                with self.lock:
+                    self.replica(base)['outstanding'] -= 1
+            if response.status_code >= 500:
+                logging.warning("%s %s Error (HTTPError) attempt %d: %s %s", method, url, i+1, response.status_code, response.reason)
+                error = HTTPError(response.status_code, response.reason)
+                if response.status_code != 503: ### 503: overloaded but alive
+                    self.set_health(base, False)
+                continue
+            if not_found and response.status_code == 404:
+                return None
+            if response.status_code >= 400:
+                raise HTTPError(response.status_code, response.reason)
+            if stream:
+                return response
+            try:
+                return response.json()
+            except requests.exceptions.JSONDecodeError as e:
+                raise InvalidResponse('response body did not contain valid json: {}'.format(e))
+        logging.error("%s %s Error: %s (after %d attempts)", method, path, error, self.retries+1)
+        raise error
+
+    def post(self, path='', **kwargs):
+        return self.request('POST', path, **kwargs)
+
+    def delete(self, path='', **kwargs):
+        return self.request('DELETE', path, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+class AsyncClient():
+    """
+    asyncio variant of Client for bulk callers: requests run on a pooled Client in a thread executor, at most max_concurrency at a time. Ex:
+        client = AsyncClient(url, max_concurrency=8)
+        results = await asyncio.gather(*[client.post(json=req) for req in reqs])
+    """
+    def __init__(self, url, max_concurrency=8, **kwargs):
+        self.client = Client(url, pool_size=max_concurrency, **kwargs)
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency)
+
+    async def request(self, method, path='', **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(self.client.request, method, path, **kwargs))
+
+    async def post(self, path='', **kwargs):
+        return await self.request('POST', path, **kwargs)
+
+    async def delete(self, path='', **kwargs):
+        return await self.request('DELETE', path, **kwargs)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        self.client.close()
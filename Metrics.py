@@ -0,0 +1,156 @@
+import time
+import threading
+from flask import Response, request, g
+
+class Registry():
+    """ metrics exported by a server, rendered in the Prometheus text format (served by the /metrics route added by instrument) """
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics)
+        lines = []
+        for m in metrics:
+            lines.append('# HELP {} {}'.format(m.name, m.help))
+            lines.append('# TYPE {} {}'.format(m.name, m.type))
+            lines += m.render()
+        return '\n'.join(lines) + '\n'
+
+registry = Registry()
+
+def format_labels(labels, extra=()):
+    items = list(labels) + list(extra)
+    if len(items) == 0:
+        return ''
+    return '{' + ','.join(['{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in items]) + '}'
+
+def format_value(v):
+    return '+Inf' if v == float('inf') else repr(float(v))
+
+class Metric():
+    """ values are kept per set of labels (keyword arguments of the update methods) """
+    type = 'untyped'
+    def __init__(self, name, help, registry=registry):
+        self.name = name
+        self.help = help
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.register(self)
+
+    def key(self, labels):
+        return tuple(sorted(labels.items()))
+
+class Counter(Metric):
+    type = 'counter'
+    def inc(self, value=1, **labels):
+        k = self.key(labels)
+        with self.lock:
+            self.values[k] = self.values.get(k, 0) + value
+
+    def render(self):
+        with self.lock:
+            return ['{}{} {}'.format(self.name, format_labels(k), format_value(v)) for k, v in self.values.items()]
+
+class Gauge(Metric):
+    """ fn: function returning the value (Ex: a queue size), read when metrics are rendered """
+    type = 'gauge'
+    def __init__(self, name, help, fn=None, registry=registry):
+        super().__init__(name, help, registry=registry)
+        self.fns = {}
+        if fn is not None:
+            self.fns[()] = fn
+
+    def set_function(self, fn, **labels):
+        with self.lock:
+            self.fns[self.key(labels)] = fn
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def inc(self, value=1, **labels):
+        k = self.key(labels)
+        with self.lock:
+            self.values[k] = self.values.get(k, 0) + value
+
+    def dec(self, value=1, **labels):
+        self.inc(-value, **labels)
+
+    def render(self):
+        with self.lock:
+            values = dict(self.values)
+            fns = dict(self.fns)
+        values.update({k: fn() for k, fn in fns.items()})
+        return ['{}{} {}'.format(self.name, format_labels(k), format_value(v)) for k, v in values.items()]
+
+TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096)
+
+class Histogram(Metric):
+    """ cumulative counts of the observations lower or equal than each bucket bound, with their sum and count """
+    type = 'histogram'
+    def __init__(self, name, help, buckets=TIME_BUCKETS, registry=registry):
+        super().__init__(name, help, registry=registry)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        k = self.key(labels)
+        with self.lock:
+            counts, total = self.values.get(k, ([0] * len(self.buckets), 0.))
+            for i, b in enumerate(self.buckets):
+                if value <= b:
+                    counts[i] += 1
+            self.values[k] = (counts, total + value)
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for k, (counts, total) in self.values.items():
+                for b, c in zip(self.buckets, counts):
+                    lines.append('{}_bucket{} {}'.format(self.name, format_labels(k, [('le', format_value(b))]), c))
+                lines.append('{}_sum{} {}'.format(self.name, format_labels(k), format_value(total)))
+                lines.append('{}_count{} {}'.format(self.name, format_labels(k), counts[-1]))
+        return lines
+
+def instrument(app, prefix, registry=registry):
+    """
+    Adds the /metrics route to the flask app, and the metrics of its requests: number by route and status, latency (until streamed responses end) and in-flight requests.
+    """
+    requests_total = Counter(prefix + '_requests_total', 'requests received', registry=registry)
+    request_seconds = Histogram(prefix + '_request_seconds', 'request latency (seconds)', registry=registry)
+    in_flight = Gauge(prefix + '_requests_in_flight', 'requests being processed', registry=registry)
+    in_flight.set(0)
+
+    def route():
+        return request.url_rule.rule if request.url_rule is not None else 'unknown'
+
+    @app.before_request
+    def before_request():
+        if route() != '/metrics':
+            g.metrics_tic = time.time()
+            in_flight.inc()
+
+    @app.after_request
+    def after_request(response):
+        if route() != '/metrics':
+            requests_total.inc(route=route(), status=response.status_code)
+        return response
+
+    @app.teardown_request
+    def teardown_request(error=None):
+        tic = g.pop('metrics_tic', None) ### streamed responses tear down their context twice
+        if tic is None:
+            return
+        in_flight.dec()
+        request_seconds.observe(time.time() - tic, route=route())
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        return Response(registry.render(), mimetype='text/plain; version=0.0.4')
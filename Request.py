@@ -2,33 +2,98 @@ import time
 import json
 import logging
 import requests
+import threading
+import http.client
+import urllib.parse
+from Client import Client, ClientError, ConnectError, RequestTimeout, HTTPError, InvalidResponse
+
+clients = {}
+clients_lock = threading.Lock()
+
+def get_client(url, timeout):
+    '''
+    Returns the Client (pool of persistent connections) shared by the requests to url
+    '''
+    with clients_lock:
+        if (url, timeout) not in clients:
+            clients[(url, timeout)] = Client(url, timeout=timeout)
+        return clients[(url, timeout)]
 
 def send_request_to_server(url, timeout, cfg, dec, txt):
     req = { 'cfg':cfg, 'dec': dec, 'txt':txt }
+    return send_json_to_server(url, timeout, req)
+
+def send_json_to_server(url, timeout, req):
+    tic = 1000*time.time()
+    res = get_client(url, timeout).post(json=req, headers={"Content-Type": "application/json"})
+    logging.info('server request took {:.2f} msec'.format(1000*time.time()-tic))
+    return res
+
+def stream_events_from_server(url, timeout, req):
+    '''
+    Sends the json request and yields the data (json) of the Server-Sent Events of the response as they arrive, with the name of the event ('message' by default)
+    '''
     tic = 1000*time.time()
+    response = get_client(url, timeout).post(json=req, headers={"Content-Type": "application/json", "Accept": "text/event-stream"}, stream=True)
     try:
-        response = requests.post(url, json=req, headers={"Content-Type": "application/json"}, timeout=timeout)
-        response.raise_for_status()
-    except requests.exceptions.ConnectionError as e:
-        logging.error("POST Request Error (ConnectionError): %s", e)
-        raise SystemExit(e)
-    except requests.exceptions.Timeout as e:
-        logging.error("POST Request Error (Timeout): %s", e)
-        raise SystemExit(e)
-    except requests.exceptions.TooManyRedirects as e:
-        logging.error("POST Request Error (TooManyRedirects): %s", e)
-        raise SystemExit(e)
-    except requests.exceptions.HTTPError as e:
-        logging.error("POST Request Error (HTTPError): %s", e)
-        raise SystemExit(e)
+        event = 'message'
+        for line in response.iter_lines(decode_unicode=True):
+            if line.startswith('event:'):
+                event = line[6:].strip()
+            elif line.startswith('data:'):
+                yield event, json.loads(line[5:])
+                event = 'message'
     except requests.exceptions.RequestException as e:
-        logging.error("POST Request Error (RequestException): %s", e)
-        raise SystemExit(e)
+        raise ClientError(str(e))
+    except json.JSONDecodeError as e:
+        raise InvalidResponse('event did not contain valid json: {}'.format(e))
+    finally:
+        response.close()
+    logging.info('server events took {:.2f} msec'.format(1000*time.time()-tic))
+
+def stream_request_to_server(url, timeout, cfg, dec, txt, path=''):
+    '''
+    Sends the sentences of the iterable txt as a chunked NDJSON request (from a separate thread) to the replica + path and yields the NDJSON lines of the response as they arrive
+    '''
+    u = urllib.parse.urlsplit(get_client(url, timeout).choose() + path)
+    conn = (http.client.HTTPSConnection if u.scheme == 'https' else http.client.HTTPConnection)(u.netloc, timeout=timeout)
+
+    def send_chunk(sock, obj):
+        chunk = (json.dumps(obj, ensure_ascii=False) + '\n').encode('utf-8')
+        sock.sendall(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+
+    def send(sock):
+        ### use the socket directly: conn closes (detaches) it once the response starts when the server does not keep the connection alive
+        try:
+            send_chunk(sock, { 'cfg':cfg, 'dec':dec })
+            for t in txt:
+                send_chunk(sock, { 'txt':t })
+            sock.sendall(b'0\r\n\r\n')
+        except OSError as e:
+            logging.error("POST Stream Error (send): %s", e)
 
+    tic = 1000*time.time()
     try:
-        res = response.json()
+        conn.putrequest('POST', u.path + ('?' + u.query if u.query else ''))
+        conn.putheader('Content-Type', 'application/x-ndjson')
+        conn.putheader('Transfer-Encoding', 'chunked')
+        conn.endheaders()
+        threading.Thread(target=send, args=(conn.sock,), daemon=True).start()
+        response = conn.getresponse()
+        if response.status != 200:
+            raise HTTPError(response.status, response.reason)
+        for line in response:
+            if line.strip():
+                res = json.loads(line)
+                if 'error' in res:
+                    raise InvalidResponse(res['error'])
+                yield res
+    except TimeoutError as e:
+        raise RequestTimeout(str(e))
+    except (OSError, http.client.HTTPException) as e:
+        raise ConnectError(str(e))
     except json.JSONDecodeError as e:
-        logging.error("Response body did not contain valid json: %s", e)
-        raise SystemExit(e)
-    logging.info('server request took {:.2f} msec'.format(1000*time.time()-tic))
-    return res
+        raise InvalidResponse('response line did not contain valid json: {}'.format(e))
+    finally:
+        conn.close()
+    logging.info('server stream took {:.2f} msec'.format(1000*time.time()-tic))
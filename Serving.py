@@ -0,0 +1,365 @@
+import sys
+import json
+import asyncio
+import logging
+import threading
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.exceptions import BadRequest, RequestTimeout
+from Metrics import Counter, Gauge
+
+rejected_total = Counter('serving_rejected_total', 'requests rejected (503) because max_pending requests were already waiting')
+cancelled_total = Counter('serving_cancelled_total', 'requests whose client disconnected before the response was sent')
+
+local = threading.local()
+
+def cancel_event():
+    """ returns the event set when the client of the request processed by the current thread disconnects (None outside the asyncio server) """
+    return getattr(local, 'cancelled', None)
+
+class Cancelled(Exception):
+    """ raised by the processing of a request whose client disconnected (Ex: by Batcher), answered with status 499 """
+    pass
+
+class Disconnected(Exception):
+    pass
+
+class Connection():
+    """
+    buffered reads of a client connection: the bytes received while a request is processed (watched to detect disconnections) are kept for the next request.
+    Reads and writes stalled for more than timeout seconds raise asyncio.TimeoutError
+    """
+    def __init__(self, reader, writer, timeout=30.0):
+        self.reader = reader
+        self.writer = writer
+        self.timeout = timeout
+        self.buffer = bytearray()
+
+    async def fill(self, timeout=-1):
+        data = await asyncio.wait_for(self.reader.read(65536), self.timeout if timeout == -1 else timeout)
+        if not data:
+            raise Disconnected()
+        self.buffer += data
+
+    async def readuntil(self, sep, limit=65536):
+        while True:
+            i = self.buffer.find(sep)
+            if i >= 0:
+                data = bytes(self.buffer[:i+len(sep)])
+                del self.buffer[:i+len(sep)]
+                return data
+            if len(self.buffer) > limit:
+                raise ValueError('line too long')
+            await self.fill()
+
+    async def readexactly(self, n):
+        while len(self.buffer) < n:
+            await self.fill()
+        data = bytes(self.buffer[:n])
+        del self.buffer[:n]
+        return data
+
+    async def readsome(self, n):
+        if len(self.buffer) == 0:
+            await self.fill()
+        data = bytes(self.buffer[:n])
+        del self.buffer[:n]
+        return data
+
+    async def watch(self, event):
+        """ sets event when the client disconnects """
+        try:
+            while True:
+                await self.fill(timeout=None) ### the request may be processed for long
+        except (Disconnected, ConnectionError):
+            event.set()
+
+    async def write(self, data):
+        self.writer.write(data)
+        await asyncio.wait_for(self.writer.drain(), self.timeout)
+
+class Body():
+    """
+    Request body given to the app as wsgi.input: it is read from the connection as the handler thread consumes it (chunked bodies are decoded on the fly),
+    so that streamed requests (Ex: /translate/stream) are processed while they are uploaded and are never held in memory.
+    length: Content-Length of the body, None if chunked. on_done is called (in the event loop) once the whole body is read
+    """
+    def __init__(self, conn, loop, length=None, on_done=None):
+        self.conn = conn
+        self.loop = loop
+        self.chunked = length is None
+        self.remaining = 0 if self.chunked else length ### bytes left in the body (current chunk if chunked)
+        self.on_done = on_done
+        self.done = False
+        self.buffer = b''
+        if not self.chunked and length == 0:
+            self.finish()
+
+    def finish(self):
+        self.done = True
+        if self.on_done is not None:
+            self.on_done()
+
+    async def next(self, n):
+        """ returns the next bytes of the body (at most n), b'' at its end """
+        if self.done:
+            return b''
+        if self.chunked and self.remaining == 0:
+            self.remaining = int((await self.conn.readuntil(b'\r\n')).split(b';')[0], 16)
+            if self.remaining == 0:
+                while await self.conn.readuntil(b'\r\n') != b'\r\n': ### trailers
+                    pass
+                self.finish()
+                return b''
+        data = await self.conn.readsome(min(n, self.remaining))
+        self.remaining -= len(data)
+        if self.remaining == 0:
+            if self.chunked:
+                await self.conn.readexactly(2) ### CRLF ending the chunk
+            else:
+                self.finish()
+        return data
+
+    def piece(self, n=65536):
+        try:
+            return asyncio.run_coroutine_threadsafe(self.next(n), self.loop).result()
+        except asyncio.TimeoutError:
+            raise RequestTimeout('the client stalled while sending the request body') ### answered 408, the connection is closed (body not done)
+        except ValueError as e:
+            raise BadRequest('malformed request body: {}'.format(e))
+
+    def read(self, size=-1):
+        """ returns up to size bytes (all the body if size < 0), fewer if the client did not send them yet """
+        if size is None or size < 0:
+            data = [self.buffer]
+            while True:
+                d = self.piece()
+                if not d:
+                    break
+                data.append(d)
+            self.buffer = b''
+            return b''.join(data)
+        if not self.buffer:
+            self.buffer = self.piece(max(size, 1))
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def readline(self, size=-1):
+        while b'\n' not in self.buffer and (size is None or size < 0 or len(self.buffer) < size):
+            d = self.piece()
+            if not d:
+                break
+            self.buffer += d
+        i = self.buffer.find(b'\n')
+        n = i + 1 if i >= 0 else len(self.buffer)
+        if size is not None and size >= 0:
+            n = min(n, size)
+        data, self.buffer = self.buffer[:n], self.buffer[n:]
+        return data
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+class Server():
+    """
+    asyncio HTTP/1.1 front end of a WSGI (flask) app: connections are handled by the event loop and requests are processed by up to threads handler threads
+    (which call the models, Ex: through a Batcher). Responses without Content-Length (streamed) are sent chunked as the app yields them.
+    - backpressure: requests arriving when max_pending requests are already waiting for a handler thread are rejected with 503 (retried elsewhere by Client)
+    - cancellation: when the client disconnects, the event returned by cancel_event() is set (requests waiting in a Batcher are dropped) and streamed responses are closed
+    - timeouts: header and body reads (and response writes) stalled for read_timeout seconds end the request (408 if possible), idle keep-alive connections are closed after keep_alive seconds
+    """
+    def __init__(self, app, host='0.0.0.0', port=8000, threads=32, max_pending=64, read_timeout=30.0, keep_alive=5.0):
+        self.app = app
+        self.host = host
+        self.port = port
+        self.threads = threads
+        self.max_pending = max_pending
+        self.read_timeout = read_timeout
+        self.keep_alive = keep_alive
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='handler')
+        self.active = 0 ### requests processed or waiting for a handler thread
+        Gauge('serving_requests_pending', 'requests waiting for a handler thread', fn=lambda: max(self.active - self.threads, 0))
+
+    def run(self):
+        logging.info('[serving] listening on http://{}:{} ({} handler threads, max_pending={})'.format(self.host, self.port, self.threads, self.max_pending))
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            pass
+
+    async def serve(self):
+        server = await asyncio.start_server(self.handle, self.host, self.port)
+        async with server:
+            await server.serve_forever()
+
+    async def handle(self, reader, writer):
+        conn = Connection(reader, writer, timeout=self.read_timeout)
+        try:
+            keep_alive, first = True, True
+            while keep_alive:
+                try:
+                    if len(conn.buffer) == 0:
+                        await conn.fill(self.read_timeout if first else self.keep_alive) ### idle keep-alive connections are closed
+                    head = await asyncio.wait_for(conn.readuntil(b'\r\n\r\n'), self.read_timeout) ### headers sent byte by byte are not waited for forever
+                except Disconnected:
+                    break
+                except asyncio.TimeoutError:
+                    if len(conn.buffer):
+                        await self.error(conn, 408, 'Request Timeout', 'request headers not received in time')
+                    break
+                except ValueError:
+                    await self.error(conn, 431, 'Request Header Fields Too Large', 'request headers too large')
+                    break
+                first = False
+                keep_alive = await self.request(conn, head, writer.get_extra_info('peername'))
+        except (Disconnected, ConnectionError, asyncio.TimeoutError):
+            pass
+        except Exception:
+            logging.exception('[serving] connection error')
+        finally:
+            writer.close()
+
+    async def error(self, conn, status, reason, message, headers=''):
+        """ answers the error (json) and asks the client to close the connection """
+        data = '{}\n'.format(json.dumps({'error': message})).encode('utf-8')
+        await conn.write('HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n{}Connection: close\r\n\r\n'.format(status, reason, len(data), headers).encode('latin-1') + data)
+
+    async def request(self, conn, head, peer):
+        """ processes the request (its body is read by the app as it needs it) and returns whether the connection is kept alive """
+        try:
+            lines = head.decode('latin-1').split('\r\n')
+            method, target, version = lines[0].split(' ', 2)
+            if not version.startswith('HTTP/'):
+                raise ValueError('invalid request line {}'.format(lines[0]))
+            headers = [tuple(x.strip() for x in line.split(':', 1)) for line in lines[1:] if ':' in line]
+            h = {k.lower(): v for k, v in headers}
+            chunked = h.get('transfer-encoding', '').lower() == 'chunked'
+            length = None if chunked else int(h.get('content-length', 0))
+            if length is not None and length < 0:
+                raise ValueError('invalid Content-Length {}'.format(length))
+        except ValueError as e:
+            logging.warning('[serving] bad request: {}'.format(e))
+            await self.error(conn, 400, 'Bad Request', 'malformed request: {}'.format(e))
+            return False
+        keep_alive = h.get('connection', '').lower() != 'close' and version == 'HTTP/1.1'
+        if self.active >= self.threads + self.max_pending: ### rejected before reading the body, the connection is closed
+            rejected_total.inc()
+            logging.warning('[serving] {} {} rejected: {} requests pending'.format(method, target, self.active - self.threads))
+            await self.error(conn, 503, 'Service Unavailable', 'server overloaded, retry later', headers='Retry-After: 1\r\n')
+            return False
+        if h.get('expect', '').lower() == '100-continue':
+            await conn.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+
+        loop = asyncio.get_running_loop()
+        event = threading.Event()
+        watch = None
+        def watch_connection(): ### once the body is read, further reads only detect disconnections
+            nonlocal watch
+            watch = asyncio.ensure_future(conn.watch(event))
+        body = Body(conn, loop, length, on_done=watch_connection)
+
+        path, _, query = target.partition('?')
+        environ = {
+            'REQUEST_METHOD': method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': urllib.parse.unquote(path, encoding='latin-1'),
+            'QUERY_STRING': query,
+            'CONTENT_TYPE': h.get('content-type', ''),
+            'SERVER_NAME': self.host,
+            'SERVER_PORT': str(self.port),
+            'SERVER_PROTOCOL': version,
+            'REMOTE_ADDR': peer[0] if peer else '',
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': body,
+            'wsgi.input_terminated': True, ### Body stops at the end of the request body
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        if not chunked:
+            environ['CONTENT_LENGTH'] = h.get('content-length', '0')
+        for k, v in headers:
+            k = k.upper().replace('-', '_')
+            if k not in ('CONTENT_TYPE', 'CONTENT_LENGTH', 'TRANSFER_ENCODING'): ### the body is decoded by Body
+                environ['HTTP_' + k] = environ['HTTP_' + k] + ',' + v if 'HTTP_' + k in environ else v
+
+        self.active += 1
+        try:
+            keep_alive = await loop.run_in_executor(self.executor, self.process, environ, event, keep_alive, conn, loop)
+        finally:
+            self.active -= 1
+            if watch is not None:
+                watch.cancel()
+                await asyncio.gather(watch, return_exceptions=True) ### the next request is read once the watch is stopped
+        if keep_alive is None:
+            cancelled_total.inc()
+            logging.info('[serving] {} {} cancelled: client disconnected'.format(method, target))
+            raise Disconnected()
+        return keep_alive and body.done ### the unread rest of the body would be taken for the next request
+
+    def process(self, environ, event, keep_alive, conn, loop):
+        """ runs the app in a handler thread and writes its response (chunked if it has no Content-Length) as it is produced, returns whether the connection is kept alive (None if the client disconnected) """
+        local.cancelled = event
+        response = {}
+        def start_response(status, headers, exc_info=None):
+            response['status'], response['headers'] = status, headers
+        def write(data):
+            if event.is_set():
+                raise Disconnected()
+            asyncio.run_coroutine_threadsafe(conn.write(data), loop).result()
+
+        result = self.app(environ, start_response)
+        try:
+            if event.is_set(): ### client gone while the app was processing
+                return None
+            headers = list(response['headers'])
+            chunked = not any(k.lower() == 'content-length' for k, _ in headers) and environ['REQUEST_METHOD'] != 'HEAD'
+            if chunked:
+                headers.append(('Transfer-Encoding', 'chunked'))
+            headers.append(('Connection', 'keep-alive' if keep_alive else 'close'))
+            write('HTTP/1.1 {}\r\n{}\r\n'.format(response['status'], ''.join(['{}: {}\r\n'.format(k, v) for k, v in headers])).encode('latin-1'))
+            for data in result:
+                if len(data):
+                    write(b'%x\r\n%s\r\n' % (len(data), data) if chunked else data)
+            if chunked:
+                write(b'0\r\n\r\n')
+            return keep_alive
+        except (Disconnected, ConnectionError, asyncio.TimeoutError): ### the client left (or stopped reading the response)
+            event.set()
+            return None
+        except Exception:
+            logging.exception('[serving] error while sending the response')
+            return False ### the response is truncated, the connection is closed
+        finally:
+            if hasattr(result, 'close'):
+                result.close() ### stops streamed responses (Ex: token generation) of disconnected clients
+            local.cancelled = None
+
+def add_arguments(parser):
+    group = parser.add_argument_group("Serving")
+    group.add_argument('--server', type=str, help='asyncio: asyncio front end with backpressure and cancellation of disconnected clients, flask: flask development server', default='asyncio')
+    group.add_argument('--threads', type=int, help='number of requests processed concurrently (handler threads)', default=32)
+    group.add_argument('--max_pending', type=int, help='maximum number of requests waiting for a handler thread (further requests are rejected with 503)', default=64)
+    group.add_argument('--read_timeout', type=float, help='seconds a stalled request (headers or body) or response write is waited for before the connection is closed (408 if possible)', default=30.0)
+    group.add_argument('--keep_alive', type=float, help='seconds an idle keep-alive connection is kept open', default=5.0)
+    group.add_argument('--inter_threads', type=int, help='number of model workers: batches processed in parallel by as many model replicas', default=1)
+    group.add_argument('--intra_threads', type=int, help='number of threads used by each model worker (0 for the default)', default=0)
+
+def run(app, args):
+    """ serves app with the server chosen in args (see add_arguments) """
+    app.register_error_handler(Cancelled, lambda e: ({'error': str(e)}, 499))
+    if args.server == 'flask':
+        app.run(host=args.host, port=args.port, threaded=True)
+    else:
+        Server(app, host=args.host, port=args.port, threads=args.threads, max_pending=args.max_pending, read_timeout=args.read_timeout, keep_alive=args.keep_alive).run()
@@ -0,0 +1,64 @@
+import numpy as np
+
+class SpeechGate():
+    """
+    Energy-based speech detection: audio is split in frames of frame seconds, a frame is speech when its RMS level exceeds threshold_db (dBFS).
+    Only the samples appended since the last update are analysed (in a single vectorized pass), the flags of the frames are kept from the released position on.
+    """
+    def __init__(self, threshold_db=-45.0, frame=0.03, pad=0.2, samplerate=16000):
+        self.threshold = 10 ** (threshold_db / 20)
+        self.frame = max(int(frame * samplerate), 1)
+        self.pad = int(pad * samplerate) ### samples of silence kept before speech
+        self.offset = 0 ### absolute position of the first frame flagged
+        self.flags = np.zeros(0, dtype=bool)
+        self.last_speech = 0 ### absolute end position of the last speech frame
+
+    def __len__(self):
+        """ absolute position of the end of the analysed frames """
+        return self.offset + len(self.flags) * self.frame
+
+    def update(self, audio):
+        """ analyses the complete frames appended to audio (AudioBuffer) since the last update """
+        if len(self) < audio.offset: ### samples released before being analysed are not speech
+            skip = -(-(audio.offset - len(self)) // self.frame)
+            self.flags = np.concatenate([self.flags, np.zeros(skip, dtype=bool)])
+        n = (len(audio) - len(self)) // self.frame
+        if n <= 0:
+            return
+        x = audio[len(self):len(self) + n * self.frame].reshape(n, self.frame)
+        flags = np.sqrt(np.mean(np.square(x, dtype=np.float32), axis=1)) > self.threshold
+        speech = np.flatnonzero(flags)
+        if len(speech):
+            self.last_speech = int(len(self) + (speech[-1] + 1) * self.frame) ### plain int: positions are sent in json requests
+        self.flags = np.concatenate([self.flags, flags])
+
+    def first_speech(self, start):
+        """ absolute position of the first speech frame after start (None if no speech was found) """
+        i = max((start - self.offset) // self.frame, 0)
+        speech = np.flatnonzero(self.flags[i:])
+        return int(self.offset + (i + speech[0]) * self.frame) if len(speech) else None
+
+    def release(self, position):
+        """ discards the flags of the frames before position """
+        k = (position - self.offset) // self.frame
+        if k > 0:
+            self.flags = self.flags[k:]
+            self.offset += k * self.frame
+
+
+if __name__ == '__main__':
+    ### check: speech after leading silence, the positions given by the gate are sent as session offsets in json requests
+    import json
+    from AudioBuffer import AudioBuffer
+    samplerate = 16000
+    t = np.arange(4 * samplerate) / samplerate
+    x = (0.3 * np.sin(2 * np.pi * 220 * t)).astype(np.float32)
+    x[:2 * samplerate] = 0.
+    audio = AudioBuffer()
+    audio.append(x)
+    gate = SpeechGate(threshold_db=-40, samplerate=samplerate)
+    gate.update(audio)
+    first = gate.first_speech(0)
+    start = first - gate.pad
+    assert abs(first - 2 * samplerate) <= gate.frame and gate.last_speech == len(gate), (first, gate.last_speech, len(gate))
+    print(json.dumps({'offset': start, 'confirmed': start, 'last_speech': gate.last_speech}))
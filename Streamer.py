@@ -1,13 +1,15 @@
-#import sys
-import os
+import sys
+import json
 import time
+import shutil
 import logging
 import numpy as np
 import threading
-import requests
-import sounddevice as sd
-import soundfile as sf
+from collections import deque
 from faster_whisper.audio import decode_audio
+from AudioBuffer import AudioBuffer
+from SpeechGate import SpeechGate
+from Client import Client, ClientError, ConnectError, RequestTimeout, HTTPError
 
 RESET = "\033[0m"
 BRIGHT_YELLOW = "\033[93m"
@@ -18,59 +20,90 @@ def save(self, data, file_name, samplerate=16000):
     Save each audio data split (transcripts) into files
     file_name: the output file name (available extensions: 'AIFF', 'AU', 'AVR', 'CAF', 'FLAC', 'HTK', 'SVX', 'MAT4', 'MAT5', 'MPC2K', 'MP3', 'OGG', 'PAF', 'PVF', 'RAW', 'RF64', 'SD2', 'SDS', 'IRCAM', 'VOC', 'W64', 'WAV', 'NIST', 'WAVEX', 'WVE', 'XI')
     """
+    import soundfile as sf
     logging.info('save data = {}'.format(data.shape))
     sf.write(file_name, data, samplerate)
 
-def send_audio_to_server(url, timeout, audio, history, task, lang, beam_size, start, samplerate):
-    req = { 'audio':audio.tolist(), 'history':history, 'task':task, 'lang':lang, 'beam_size':beam_size }
-    
-    tic = time.time()
-    try:
-        response = requests.post(url, json=req, headers={"Content-Type": "application/json"}, timeout=timeout)
-        response.raise_for_status()
-    except requests.exceptions.ConnectionError as e:
-        logging.error("POST Request Error (ConnectionError): %s", e)
-        raise SystemExit(e)
-    except requests.exceptions.Timeout as e: 
-        logging.error("POST Request Error (Timeout): %s", e)
-        raise SystemExit(e)
-    except requests.exceptions.ConnectionError as e:
-        logging.error("POST Request Error (ConnectionError): %s", e)
-        raise SystemExit(e)
-    except requests.exceptions.TooManyRedirects as e: 
-        logging.error("POST Request Error (TooManyRedirects): %s", e)
-        raise SystemExit(e)
-    except requests.exceptions.HTTPError as e:
-        logging.error("POST Request Error (HTTPError): %s", e)
-        raise SystemExit(e)
-    except requests.exceptions.RequestException as e: 
-        logging.error("POST Request Error (RequestException): %s", e)
-        raise SystemExit(e)
-    try:
-        out = response.json()
-    except requests.exceptions.JSONDecodeError as e:
-        logging.error("Response body did not contain valid json: %s", e)
-        raise SystemExit(e)
-    logging.debug('server request took {:.2f} sec time(audio)={} ntoks={}'.format(time.time()-tic, len(audio)/samplerate, len(out['hyp'])))
+def encode_audio(audio, opts, dtype='float32'):
+    """
+    Returns the request arguments to send audio as raw little-endian PCM (dtype: float32, int16) with options in the X-Whisper-Options header
+    """
+    if dtype == 'int16':
+        data = (np.clip(audio, -1.0, 1.0) * 32767).astype('<i2').tobytes()
+    else:
+        data = np.asarray(audio, dtype='<f4').tobytes()
+    headers = {"Content-Type": "application/octet-stream", "X-Audio-Format": dtype, "X-Whisper-Options": json.dumps(opts)}
+    return { 'data':data, 'headers':headers }
 
+def to_samples(out, start, samplerate):
+    """ converts word times (seconds since the beginning of the audio sent) into absolute sample positions """
     for i in range(len(out['hyp'])):
         out['hyp'][i]['start'] = int(out['hyp'][i]['start'] * samplerate) + start
         out['hyp'][i]['end'] = int(out['hyp'][i]['end'] * samplerate) + start
     return out
 
+def send_audio_to_server(client, audio, history, task, lang, beam_size, start, samplerate, binary=True, dtype='float32'):
+    """
+    binary: send audio as raw little-endian PCM (dtype: float32, int16) with options in the X-Whisper-Options header, otherwise use the (slower) JSON request
+    """
+    opts = { 'history':history, 'task':task, 'lang':lang, 'beam_size':beam_size }
+    if binary:
+        kwargs = encode_audio(audio, opts, dtype=dtype)
+    else:
+        opts['audio'] = audio.tolist()
+        kwargs = { 'json':opts, 'headers':{"Content-Type": "application/json"} }
+    
+    tic = time.time()
+    out = client.post(**kwargs)
+    logging.debug('server request took {:.2f} sec time(audio)={} ntoks={}'.format(time.time()-tic, len(audio)/samplerate, len(out['hyp'])))
+    return to_samples(out, start, samplerate)
+
+def open_session(client):
+    """ returns the session id and the replica (server url) holding it, next session requests must be sent to this replica """
+    replica = client.choose()
+    return client.post('/session', replica=replica)['session'], replica
+
+def close_session(client, session, replica=None):
+    client.delete('/session/' + session, not_found=True, replica=replica)
+
+def send_audio_to_session(client, session, audio, offset, confirmed, history, task, lang, beam_size, samplerate, dtype='float32', replica=None):
+    """
+    Uploads only the new samples (audio starts at the absolute position offset) to the server session which transcribes its audio since the confirmed position.
+    Returns None if the session is unknown by the server (expired, server restarted).
+    The server transcribes from out['start'] if it already released samples after confirmed (requests in flight arriving out of order)
+    """
+    opts = { 'history':history, 'task':task, 'lang':lang, 'beam_size':beam_size, 'offset':offset, 'confirmed':confirmed }
+    tic = time.time()
+    out = client.post('/session/' + session, not_found=True, replica=replica, **encode_audio(audio, opts, dtype=dtype))
+    if out is None:
+        return None
+    logging.debug('server request took {:.2f} sec time(new audio)={} time(audio)={} ntoks={}'.format(time.time()-tic, len(audio)/samplerate, (out['end']-confirmed)/samplerate, len(out['hyp'])))
+    out['start'] = out.get('start', confirmed)
+    return to_samples(out, out['start'], samplerate)
+
 
 class Segments():
-    def __init__(self, samplerate, min_common_words, min_remain_words, max_segment_time):
+    """
+    Transcript state: the last max_segments hypotheses (segments), the confirmed text (grown incrementally) and its last history_words words
+    (sent as history/initial_prompt). The cost of an update does not depend on the length of the session.
+    """
+    def __init__(self, samplerate, min_common_words, min_remain_words, max_segment_time, clock=None, history_words=50, max_segments=16):
         self.samplerate = samplerate
         self.min_common_words = min_common_words
         self.min_remain_words = min_remain_words
         self.max_segment_time = max_segment_time
         self.tini = time.time()
-        s = { 'start':0, 'end':0, 'lang':'', 'langP':'', 'pref':[{'start':0, 'end':0, 'word':''}], 'hyp':[] }
-        self.segments = [s]
+        self.skipped = 0 ### end of the silence confirmed without words
+        self.clock = clock if clock is not None else (lambda: time.time() - self.tini) ### seconds of stream elapsed, used to compute the confirmation delay
+        self.text = '' ### confirmed text
+        self.words = deque(maxlen=history_words) ### last confirmed words
+        self.end = 0 ### end of the last confirmed word
+        self.screen = Screen()
+        s = { 'start':0, 'end':0, 'lang':'', 'langP':'', 'hyp':[] }
+        self.segments = deque([s], maxlen=max(max_segments, 2))
 
-    def __call__(self, start, end, lang, langP, pref, hyp, finish=False):
-        t = { 'start':start, 'end':end, 'lang':lang, 'langP':langP, 'pref':pref, 'hyp':hyp }
+    def __call__(self, start, end, lang, langP, hyp, finish=False):
+        t = { 'start':start, 'end':end, 'lang':lang, 'langP':langP, 'hyp':hyp }
         self.segments.append(t)
         self.log()
         """
@@ -87,7 +120,7 @@ class Segments():
         if finish:
             k_common = len(last['hyp'])
             self.confirm(k_common)
-            print()
+            self.screen.finish()
             return
         
         duration_time = (last['end'] - last['start']) / self.samplerate
@@ -100,6 +133,7 @@ class Segments():
 
         if last['start'] != prev['start']:
             logging.debug('[Streamer] FAIL diff start')
+            self.screen(self.hyp())
             return
             
         """ compute the number of initial common tokens between last and prev hypotheses """
@@ -112,30 +146,44 @@ class Segments():
             return
                         
         logging.debug('[Streamer] FAIL no common/remain words')
+        self.screen(self.hyp())
         return
 
     def confirm(self, k_common):
-        """ remove the initial k_common words from hyp and add them to the end of pref """
+        """ remove the initial k_common words from hyp and add them to the end of the confirmed text """
         assert len(self.segments)
         assert len(self.segments[-1]['hyp']) >= k_common
-        self.segments[-1]['pref']   += self.segments[-1]['hyp'][:k_common]
-        self.segments[-1]['hyp']     = self.segments[-1]['hyp'][k_common:]
-        #logging.info("[Streamer] CONFIRM                                 < {} +++ {} > k={}".format(self.pref(), self.hyp(), k_common))
-        real_time = time.time() - self.tini
+        words = self.segments[-1]['hyp'][:k_common]
+        self.segments[-1]['hyp'] = self.segments[-1]['hyp'][k_common:]
+        text = ''.join([x['word'] for x in words])
+        if len(self.text) == 0:
+            text = text.lstrip()
+        self.text += text
+        self.words.extend(words)
+        if len(words):
+            self.end = words[-1]['end']
+        real_time = self.clock()
         conf_time = self.confirmed() / self.samplerate
         logging.info("[Streamer] CONFIRM k={} delay={:.2f}".format(k_common, real_time-conf_time))
         logging.debug("[Streamer] real: {:.2f} conf: {:.2f} delay: {:.2f}".format(real_time, conf_time, real_time-conf_time))
-        ### clear screen
-        os.system('cls' if os.name == 'nt' else 'clear')
-        print(f"\r{BRIGHT_YELLOW}{self.pref()} {BRIGHT_WHITE}{self.hyp()}{RESET}", end="")
-            
+        self.screen(self.hyp(), confirmed=text)
+
+    def advance(self, position):
+        """ confirms the audio up to position (silence, no words) """
+        self.skipped = max(self.skipped, position)
+
     def confirmed(self):
-        return self.segments[-1]['pref'][-1]['end']
+        return max(self.end, self.skipped)
     
     def pref(self, get_list=False):
+        """ the confirmed text (its last history_words words if get_list) """
         if get_list:
-            return self.segments[-1]['pref']
-        return ''.join([ x['word'] for x in self.segments[-1]['pref'] ]).strip()
+            return list(self.words)
+        return self.text
+
+    def history(self):
+        """ the last history_words confirmed words (prompt of the next request) """
+        return ''.join([ x['word'] for x in self.words ]).strip()
 
     def hyp(self, get_list=False):
         if get_list:
@@ -148,18 +196,52 @@ class Segments():
         indexs += ''.join([" "]*(15-len(indexs)))
         times = "[{:.2f}-{:.2f}]".format(s['start']/self.samplerate, s['end']/self.samplerate)
         times += ''.join([" "]*(15-len(times)))
-        logging.info("[Streamer] SEGMENT {} {} < {} +++ {} >".format(indexs, times, self.pref(), self.hyp()))
+        logging.info("[Streamer] SEGMENT {} {} < {} +++ {} >".format(indexs, times, self.history(), self.hyp()))
+
+class Screen():
+    """
+    Draws the transcript in place with ANSI escape codes: confirmed text is printed once (yellow), the hypothesis (white) following it is erased
+    and redrawn on each update. Only the new text is written, whatever the length of the transcript.
+    """
+    def __init__(self, out=sys.stdout):
+        self.out = out
+        self.column = 0 ### column where the hypothesis starts
+        self.hyp = 0 ### length of the hypothesis drawn
+
+    def __call__(self, hyp, confirmed=''):
+        width = max(shutil.get_terminal_size().columns, 1)
+        erase = ''
+        if self.hyp:
+            rows = (self.column + self.hyp - 1) // width ### rows below the one where the hypothesis starts
+            erase = ('\033[{}A'.format(rows) if rows else '') + '\r' + ('\033[{}C'.format(self.column) if self.column else '') + '\033[J'
+        if len(confirmed) and self.column == 0 and self.hyp == 0:
+            confirmed = confirmed.lstrip()
+        self.column = (self.column + len(confirmed)) % width
+        hyp = (' ' if self.column and len(hyp) else '') + hyp
+        self.hyp = len(hyp)
+        self.out.write(erase + BRIGHT_YELLOW + confirmed + BRIGHT_WHITE + hyp + RESET)
+        self.out.flush()
+
+    def finish(self):
+        self.out.write('\n')
+        self.out.flush()
+        self.column = 0
+        self.hyp = 0
     
 class Streamer():
 
-    def __init__(self, url, timeout=10.0, channels=1, samplerate=16000, blocksize=4096, audio_file=None, task='transcribe', lang=None, beam_size=5, every=1.0, min_common_words=2, min_remain_words=2, max_segment_time=5.0, play=False):
+    def __init__(self, url, timeout=10.0, channels=1, samplerate=16000, blocksize=4096, audio_file=None, task='transcribe', lang=None, beam_size=5, every=1.0, min_common_words=2, min_remain_words=2, max_segment_time=5.0, play=False, binary=True, dtype='float32', session=True, offline=False, gate_db=None, history_words=50, max_inflight=1, adaptive=False, min_every=0.25, max_every=5.0):
         self.url = url
         self.timeout = timeout
+        self.client = Client(url, timeout=timeout)
         self.channels = channels
         self.blocksize = blocksize
         self.samplerate = samplerate
         self.audio_file = decode_audio(audio_file, sampling_rate=samplerate) if audio_file is not None else None
-        self.mic = sd.default.device[0] if self.channels == 1 else sd.default.device[1]
+        self.offline = offline and self.audio_file is not None ### simulated capture clock, no sound device
+        if not self.offline:
+            import sounddevice as sd
+            self.mic = sd.default.device[0] if self.channels == 1 else sd.default.device[1]
         self.min_common_words = min_common_words
         self.min_remain_words = min_remain_words
         self.max_segment_time = max_segment_time
@@ -167,20 +249,54 @@ class Streamer():
         self.task = task
         self.lang = lang
         self.every = every
+        self.max_inflight = max(max_inflight, 1)
+        self.adaptive = adaptive
+        self.min_every = min_every
+        self.max_every = max_every
+        self.binary = binary
+        self.dtype = dtype
+        self.use_session = session and binary ### sessions need binary requests
         """
-        audio: the entire audio wave
+        audio: the audio wave (samples before the confirmed position are released)
         segments: list containing information from each call to whisper
         audio_lock: to prevent from concurrent access (read/write) to audio
+        session: server session id (None if not opened), the server keeps the audio not yet confirmed
+        replica: server url (among the replicas of url) holding the session
+        sent: absolute position of the end of the audio uploaded to the session
+        gate: speech detector (None if gate_db is None), requests are skipped while no speech arrives and leading silence is confirmed without being sent
+        requested: absolute position of the end of the audio of the last request
+        silent_sent: a request without new speech was already sent (to confirm the pending words)
+        state_lock: to prevent from concurrent access to segments/session by the requests in flight
+        applied: absolute position of the end of the audio of the last answer applied to segments (older answers are dropped)
+        latency: moving average of the request latency (seconds)
+        due/busy/stopped/error: scheduler state, shared with the worker threads through the condition cv
         """
-        self.audio = np.empty(0, dtype=np.float32)
-        self.segments = Segments(self.samplerate, self.min_common_words, self.min_remain_words, self.max_segment_time)
+        self.audio = AudioBuffer(capacity=int(2*max_segment_time*samplerate))
+        self.segments = Segments(self.samplerate, self.min_common_words, self.min_remain_words, self.max_segment_time, clock=(lambda: len(self.audio) / self.samplerate) if self.offline else None, history_words=history_words)
         self.audio_lock = threading.Lock()
+        self.session = None
+        self.replica = None
+        self.sent = 0
+        self.gate = SpeechGate(threshold_db=gate_db, samplerate=samplerate) if gate_db is not None else None
+        self.requested = 0
+        self.silent_sent = False
+        self.state_lock = threading.RLock()
+        self.applied = 0
+        self.latency = None
+        self.cv = threading.Condition()
+        self.due = False
+        self.busy = 0
+        self.stopped = False
+        self.error = None
 
-        if audio_file is not None and play:
+        if audio_file is not None and play and not self.offline:
             self.play()
         
 
     def __call__(self):
+        if self.offline:
+            return self.run_offline()
+        import sounddevice as sd
 
         def callback(indata, frames, time, status):
             """
@@ -193,7 +309,7 @@ class Streamer():
             if status:
                 logging.error('callback error: '.format(status))
             with self.audio_lock:
-                self.audio = np.concatenate((self.audio, indata.squeeze()), dtype=np.float32)
+                self.audio.append(indata.squeeze())
             logging.debug('[callback] len(audio)={}'.format(len(self.audio)))
 
         def callback_fake(indata, frames, time, status):
@@ -207,42 +323,208 @@ class Streamer():
             if status:
                 logging.error('callback_fake error: '.format(status))
             with self.audio_lock:
-                self.audio = self.audio_file[:len(self.audio)+len(indata.squeeze())]
+                n = len(self.audio)
+                self.audio.append(self.audio_file[n:n+len(indata.squeeze())])
             logging.debug('[callback_fake] len(audio)={}'.format(len(self.audio)))
         
         """
         infinite loop (stopped using [Ctrl+c]) or end of audio_file
         """
         
-        with sd.InputStream(device=self.mic, channels=self.channels, callback=callback_fake if self.audio_file is not None else callback, blocksize=self.blocksize, samplerate=self.samplerate):
-            next_stream = time.time() + self.every
-            while True:
-                now = time.time()
-                if next_stream-now > 0:
-                    logging.info('sleep({:.2f})'.format(next_stream-now))
-                    time.sleep(next_stream-now)
-                else:
-                    logging.info('late({:.2f})'.format(now-next_stream))                    
-                next_stream += self.every
+        workers = [threading.Thread(target=self.work, name='transcribe-{}'.format(i), daemon=True) for i in range(self.max_inflight)]
+        for w in workers:
+            w.start()
+        try:
+            with sd.InputStream(device=self.mic, channels=self.channels, callback=callback_fake if self.audio_file is not None else callback, blocksize=self.blocksize, samplerate=self.samplerate):
+                next_stream = time.time() + self.every
+                while True:
+                    now = time.time()
+                    if next_stream-now > 0:
+                        logging.info('sleep({:.2f})'.format(next_stream-now))
+                        time.sleep(next_stream-now)
+                    else:
+                        logging.info('late({:.2f})'.format(now-next_stream))                    
+                    next_stream = max(next_stream, now) + self.every
+                    self.submit()
+                    if self.audio_file is not None and len(self.audio) == len(self.audio_file):
+                        break
+                self.drain()
+                self.transcribe(finish=True)
+        finally:
+            with self.cv:
+                self.stopped = True
+                self.cv.notify_all()
+            self.close()
+
+    def submit(self):
+        """ requests the transcription of the current window: a window waiting for a worker is superseded (dropped) by the newer one """
+        with self.cv:
+            if self.error is not None:
+                raise self.error
+            if self.due:
+                logging.info('stale window dropped ({} requests in flight)'.format(self.busy))
+            self.due = True
+            self.cv.notify()
+
+    def drain(self):
+        """ waits until the submitted windows are transcribed """
+        with self.cv:
+            while (self.due or self.busy) and self.error is None:
+                self.cv.wait()
+            if self.error is not None:
+                raise self.error
+
+    def work(self):
+        """ worker thread: transcribes the windows submitted (up to max_inflight workers have a request in flight) """
+        while True:
+            with self.cv:
+                while not self.due and not self.stopped:
+                    self.cv.wait()
+                if self.stopped:
+                    return
+                self.due = False
+                self.busy += 1
+            try:
                 self.transcribe()
-                if self.audio_file is not None and len(self.audio) == len(self.audio_file):
-                    break
-            self.transcribe(finish=True)
+            except Exception as e:
+                logging.error('transcribe error ({}): {}'.format(type(e).__name__, e))
+                with self.cv:
+                    self.error = e
+            finally:
+                with self.cv:
+                    self.busy -= 1
+                    self.cv.notify_all()
+
+    def measured(self, seconds):
+        """ updates the request latency, and every (when adaptive) so that a request is sent as soon as a worker is free """
+        self.latency = seconds if self.latency is None else 0.8 * self.latency + 0.2 * seconds
+        if self.adaptive:
+            self.every = min(max(self.latency / self.max_inflight, self.min_every), self.max_every)
+            logging.debug('latency={:.2f} every={:.2f}'.format(self.latency, self.every))
 
     def transcribe(self, finish=False):
-        logging.info('stream({:.2f})'.format(time.time()-self.segments.tini))
-        start = self.segments.confirmed()
-        pref = self.segments.pref(get_list=True)
+        """
+        Transcribes the audio since the confirmed position and updates segments with the answer.
+        Requests in flight may overlap: each one prepares its window and applies its answer under state_lock, the answer of a window older than the last applied one is dropped
+        """
+        with self.state_lock:
+            logging.info('stream({:.2f})'.format(time.time()-self.segments.tini))
+            start = self.segments.confirmed()
+            if self.gate is not None and not finish:
+                start = self.gated(start)
+                if start is None:
+                    return
+            if self.use_session and self.session is None:
+                self.session, self.replica = open_session(self.client)
+                self.sent = start
+            with self.audio_lock:
+                self.audio.release(start) ### samples before the confirmed position are never sent again
+                if self.gate is not None:
+                    self.gate.release(start)
+                end = len(self.audio)
+                self.requested = end
+                offset = max(self.sent, start) if self.use_session else start ### sessions only receive new samples
+                audio = self.audio[offset:end].copy()
+            if self.use_session:
+                self.sent = max(self.sent, end) ### concurrent requests do not upload the samples in flight again
+            history = self.segments.history()
+            session = self.session
+
+        tic = time.time()
+        if not self.use_session:
+            out = send_audio_to_server(self.client, audio, history, self.task, self.lang, self.beam_size, start, self.samplerate, binary=self.binary, dtype=self.dtype)
+        else:
+            try:
+                out = send_audio_to_session(self.client, session, audio, offset, start, history, self.task, self.lang, self.beam_size, self.samplerate, dtype=self.dtype, replica=self.replica)
+            except (ConnectError, RequestTimeout) as e:
+                if len(self.client.replicas) == 1:
+                    raise
+                logging.warning('replica {} holding session {} failed: {}'.format(self.replica, session, e))
+                out = None ### the session is lost with its replica
+            if out is None:
+                with self.state_lock:
+                    if self.session == session: ### not reopened by a concurrent request
+                        logging.warning('session {} unknown by server, opening a new one'.format(session))
+                        self.session, self.replica = open_session(self.client)
+                        self.sent = end ### rolled back: the new session only holds the samples uploaded below
+                    session = self.session
+                    with self.audio_lock:
+                        start = max(start, self.audio.offset) ### samples released by a concurrent request meanwhile
+                        audio = self.audio[start:end].copy()
+                out = send_audio_to_session(self.client, session, audio, start, start, history, self.task, self.lang, self.beam_size, self.samplerate, dtype=self.dtype, replica=self.replica)
+                if out is None:
+                    raise HTTPError(404, 'session {} unknown by server'.format(session))
+            start = max(start, out['start'])
+            end = max(end, out['end']) ### the session may hold audio uploaded by a concurrent request
+        self.measured(time.time() - tic)
+
+        with self.state_lock:
+            if end < self.applied and not finish:
+                logging.info('stale answer dropped [{:.2f}-{:.2f}]'.format(start/self.samplerate, end/self.samplerate))
+                return
+            self.applied = end
+            confirmed = self.segments.confirmed()
+            if confirmed > start: ### words confirmed by a concurrent answer meanwhile
+                out['hyp'] = [w for w in out['hyp'] if w['end'] > confirmed]
+                start = confirmed
+            self.segments(start, end, out['lang'], out['langP'], out['hyp'], finish=finish)
+
+    def gated(self, start):
+        """
+        Analyses the new audio with the speech gate. Returns the position from which audio must be transcribed (after the leading silence when
+        no words are pending) or None if the request can be skipped: no speech arrived since the last request and no pending words need it to be confirmed
+        """
         with self.audio_lock:
-            end = len(self.audio)
-        out = send_audio_to_server(self.url, self.timeout, self.audio[start:end], self.segments.pref(), self.task, self.lang, self.beam_size, start, self.samplerate)
-        self.segments(start, end, out['lang'], out['langP'], pref, out['hyp'], finish=finish)
+            self.gate.update(self.audio)
+        pending = len(self.segments.hyp(get_list=True)) > 0
+        if not pending:
+            first = self.gate.first_speech(start)
+            silence_end = (first if first is not None else len(self.gate)) - self.gate.pad
+            if silence_end > start:
+                logging.debug('[Streamer] silence [{:.2f}-{:.2f}] confirmed'.format(start/self.samplerate, silence_end/self.samplerate))
+                self.segments.advance(silence_end)
+                start = silence_end
+        if self.gate.last_speech > self.requested:
+            self.silent_sent = False
+        elif not pending or self.silent_sent:
+            logging.info('skip (no speech since last request)')
+            return None
+        else:
+            self.silent_sent = True
+        return start
+
+    def close(self):
+        if self.session is not None:
+            try:
+                close_session(self.client, self.session, replica=self.replica)
+            except ClientError as e:
+                logging.warning('could not close session {}: {}'.format(self.session, e))
+            self.session = None
+
+    def run_offline(self):
+        """
+        Streams audio_file faster than real time: the capture clock is simulated, each step appends the next every seconds of audio
+        and transcribes as soon as the server answered the previous request (confirmation delays are measured on the simulated clock)
+        """
+        step = max(int(self.every * self.samplerate), 1)
+        tic = time.time()
+        try:
+            while len(self.audio) < len(self.audio_file):
+                with self.audio_lock:
+                    n = len(self.audio)
+                    self.audio.append(self.audio_file[n:n+step])
+                self.transcribe()
+            self.transcribe(finish=True)
+        finally:
+            self.close()
+        elapsed = time.time() - tic
+        logging.info('offline: {:.2f} sec of audio in {:.2f} sec (x{:.1f} real time)'.format(len(self.audio_file)/self.samplerate, elapsed, len(self.audio_file)/self.samplerate/max(elapsed, 1e-6)))
 
-            
     def play(self, wait=False):
         """ 
         Play audio data
         """
+        import sounddevice as sd
         logging.info('playing')
         sd.play(self.audio_file, self.samplerate)
         if wait:
@@ -0,0 +1,355 @@
+"""
+Load testing of the servers: each server is started in a subprocess with stand-in models (no model files, runs offline on CPU) and receives the requests of
+--requests clients for each combination of --concurrency and --sizes (sentences per request for translate, seconds of audio per request for whisper, words
+of the text for rewrAIte). Latency percentiles, requests/s and tokens/s of each run are written to a json file. Ex:
+    python benchmark.py translate --concurrency 1 8 32 --sizes 1 16 --output bench-translate.json
+    python benchmark.py whisper --concurrency 1 4 16 --sizes 1 5 10 -- --max_batch 8
+    python benchmark.py rewrAIte --concurrency 1 4 --sizes 10 40 --structured
+Arguments after -- are passed to the server script. Use --url to benchmark a server already running (with real models) instead.
+
+Stand-in models sleep rather than compute (as ctranslate2, they release the GIL): a call costs --call_ms plus --token_ms per decoding step of its longest
+item (plus --audio_ms per second of audio for whisper), so batching and queuing behave as with a real batched decoder.
+"""
+import os
+import re
+import sys
+import json
+import time
+import types
+import runpy
+import socket
+import logging
+import argparse
+import requests
+import tempfile
+import threading
+import subprocess
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from Client import Client, ClientError
+
+SCRIPTS = {'translate': 'translate-server.py', 'whisper': 'whisper-server.py', 'rewrAIte': 'rewrAIte-server.py'}
+ROUTES = {'translate': '/translate', 'whisper': '/whisper', 'rewrAIte': '/rewrAIte'}
+
+### stand-in models
+
+cost = {'call_ms': 5.0, 'token_ms': 0.5, 'audio_ms': 10.0}
+
+def spend(steps, seconds=0.):
+    time.sleep((cost['call_ms'] + cost['token_ms'] * steps + cost['audio_ms'] * seconds) / 1000)
+
+class Vocab():
+    """ ids of the pieces (words and spaces) of the stand-in tokenizers """
+    def __init__(self):
+        self.ids = {}
+        self.pieces = []
+        self.lock = threading.Lock()
+
+    def encode(self, text):
+        pieces = re.findall(r'\s+|\S+', text)
+        with self.lock:
+            for p in pieces:
+                if p not in self.ids:
+                    self.ids[p] = len(self.pieces)
+                    self.pieces.append(p)
+            return [self.ids[p] for p in pieces]
+
+    def decode(self, ids):
+        return ''.join([self.pieces[i] for i in ids])
+
+vocab = Vocab()
+
+class StandInTokenizer():
+    """ pyonmttok.Tokenizer: splits on spaces """
+    def __init__(self, mode, **kwargs):
+        pass
+
+    def tokenize(self, text):
+        return text.split(), None
+
+    def tokenize_batch(self, txt):
+        return [t.split() for t in txt], None
+
+    def detokenize(self, tokens):
+        return ' '.join(tokens)
+
+class StandInTranslator():
+    """ ctranslate2.Translator: copies the source tokens """
+    def __init__(self, model_path, **kwargs):
+        pass
+
+    def translate_batch(self, source, num_hypotheses=1, **kwargs):
+        spend(max([len(s) for s in source], default=0))
+        return [types.SimpleNamespace(hypotheses=[list(s)]*num_hypotheses, scores=[0.0]*num_hypotheses, attention=[]) for s in source]
+
+class StandInGenerator():
+    """ ctranslate2.Generator: rewrites the text of the prompt as '<fix> text </fix>' followed by '<par> text </par>' lines """
+    def __init__(self, model_path, **kwargs):
+        pass
+
+    def output(self, prompt, static_prompt, max_length):
+        prompt = ''.join((static_prompt or []) + list(prompt))
+        text = prompt.split('<</SYS>>\n\n')[-1].split(' [/INST]')[0]
+        if prompt.endswith('<par>'):
+            output = ' {} </par>\n'.format(text)
+        else:
+            output = '<fix> {} </fix>\n'.format(text) + '<par> {} </par>\n'.format(text) * 8
+        return vocab.encode(output)[:max_length]
+
+    def generate_batch(self, prompts, max_length=256, include_prompt_in_result=True, static_prompt=None, num_hypotheses=1, **kwargs):
+        outputs = [self.output(p, static_prompt, max_length) for p in prompts]
+        spend(max([len(o) for o in outputs], default=0))
+        return [types.SimpleNamespace(sequences_ids=[o]*num_hypotheses, sequences=[vocab.decode(o)]*num_hypotheses) for o in outputs]
+
+    def generate_tokens(self, prompt, max_length=256, static_prompt=None, **kwargs):
+        spend(0)
+        for i, token_id in enumerate(self.output(prompt, static_prompt, max_length)):
+            time.sleep(cost['token_ms'] / 1000)
+            yield types.SimpleNamespace(token_id=token_id, token=vocab.pieces[token_id], is_last=False, step=i)
+
+class StandInAutoTokenizer():
+    """ transformers.AutoTokenizer """
+    @classmethod
+    def from_pretrained(cls, model_id):
+        return cls()
+
+    def encode(self, text, add_special_tokens=True):
+        return vocab.encode(text)
+
+    def convert_ids_to_tokens(self, ids):
+        return [vocab.pieces[i] for i in ids]
+
+    def decode(self, ids):
+        return vocab.decode(ids)
+
+def words(start, end):
+    """ one word every half second """
+    return [types.SimpleNamespace(start=t, end=t+0.4, word=' w{}'.format(int(t*2)), probability=0.9) for t in np.arange(start, end-0.4, 0.5)]
+
+class StandInWhisperModel():
+    """ faster_whisper.WhisperModel """
+    def __init__(self, size, **kwargs):
+        pass
+
+    def transcribe(self, audio, language=None, **kwargs):
+        seconds = len(audio) / 16000
+        segment = types.SimpleNamespace(start=0.0, end=seconds, words=words(0.0, seconds))
+        spend(len(segment.words), seconds)
+        return iter([segment]), types.SimpleNamespace(language=language or 'en', language_probability=1.0)
+
+STAND_IN_FASTER_WHISPER = '1.2.1' ### version reported by the stand-in faster_whisper module
+
+class StandInBatchedInferencePipeline():
+    """ faster_whisper.BatchedInferencePipeline: clips are decoded in parallel, clip_timestamps are read as the reported version does (samples before 1.2, seconds since) """
+    def __init__(self, model):
+        pass
+
+    def transcribe(self, audio, language=None, clip_timestamps=(), **kwargs):
+        samples = tuple([int(x) for x in STAND_IN_FASTER_WHISPER.split('.')[:2]]) < (1, 2)
+        if samples and not all([isinstance(c['start'], (int, np.integer)) and isinstance(c['end'], (int, np.integer)) for c in clip_timestamps]):
+            raise TypeError('clip_timestamps must be sample indices for faster_whisper {} (audio[clip["start"]:clip["end"]])'.format(STAND_IN_FASTER_WHISPER))
+        clips = [(int(c['start']), int(c['end'])) if samples else (int(c['start'] * 16000), int(c['end'] * 16000)) for c in clip_timestamps]
+        for start, end in clips:
+            if not 0 <= start < end <= len(audio):
+                raise ValueError('clip [{}, {}) outside the {} samples of audio: wrong clip_timestamps units for faster_whisper {}'.format(start, end, len(audio), STAND_IN_FASTER_WHISPER))
+        segments = [types.SimpleNamespace(start=start/16000, end=end/16000, words=words(start/16000, end/16000)) for start, end in clips]
+        spend(max([len(s.words) for s in segments], default=0), max([s.end - s.start for s in segments], default=0))
+        return iter(segments), types.SimpleNamespace(language=language or 'en', language_probability=1.0)
+
+def stand_in_speech_timestamps(audio, vad_options=None, sampling_rate=16000, **kwargs):
+    """ faster_whisper.vad.get_speech_timestamps: the benchmark audio is all speech """
+    return [{'start': 0, 'end': len(audio)}] if len(audio) else []
+
+def install_stand_ins():
+    """ registers the stand-in models as the modules imported by the server scripts """
+    sys.modules['pyonmttok'] = types.ModuleType('pyonmttok')
+    sys.modules['pyonmttok'].Tokenizer = StandInTokenizer
+    sys.modules['ctranslate2'] = types.ModuleType('ctranslate2')
+    sys.modules['ctranslate2'].Translator = StandInTranslator
+    sys.modules['ctranslate2'].Generator = StandInGenerator
+    sys.modules['transformers'] = types.ModuleType('transformers')
+    sys.modules['transformers'].AutoTokenizer = StandInAutoTokenizer
+    sys.modules['faster_whisper'] = types.ModuleType('faster_whisper')
+    sys.modules['faster_whisper'].WhisperModel = StandInWhisperModel
+    sys.modules['faster_whisper'].BatchedInferencePipeline = StandInBatchedInferencePipeline
+    sys.modules['faster_whisper'].__version__ = STAND_IN_FASTER_WHISPER
+    sys.modules['faster_whisper.vad'] = types.ModuleType('faster_whisper.vad')
+    sys.modules['faster_whisper.vad'].get_speech_timestamps = stand_in_speech_timestamps
+
+### server
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def serve(server, port, server_args):
+    """ runs the server script (in this process) with the stand-in models """
+    install_stand_ins()
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), SCRIPTS[server])
+    sys.argv = [script, '--host', '127.0.0.1', '--port', str(port)] + server_args
+    runpy.run_path(script, run_name='__main__')
+
+def start_server(server, port, server_args, log_file, timeout=60.0):
+    """ starts the server subprocess and waits until it answers /health """
+    cmd = [sys.executable, os.path.abspath(__file__), server, '--serve', '--port', str(port)]
+    cmd += ['--call_ms', str(cost['call_ms']), '--token_ms', str(cost['token_ms']), '--audio_ms', str(cost['audio_ms']), '--'] + server_args
+    log = open(log_file, 'w') if log_file is not None else subprocess.DEVNULL
+    proc = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError('{} server exited with code {}'.format(server, proc.returncode))
+        try:
+            requests.get('http://127.0.0.1:{}/health'.format(port), timeout=1.0)
+            return proc
+        except requests.exceptions.RequestException:
+            time.sleep(0.2)
+    proc.kill()
+    raise RuntimeError('{} server did not start within {} seconds'.format(server, timeout))
+
+### load
+
+def random_words(rng, n):
+    return ' '.join([''.join(rng.choice(list('abcdefghijklmnopqrstuvwxyz'), size=rng.integers(2, 9))) for _ in range(n)])
+
+def build_requests(server, size, n, args, rng):
+    """ returns the n request kwargs (for Client.post) of the given size, and the function counting the output tokens of a response """
+    if server == 'translate':
+        reqs = [{'json': {'cfg': args.cfg, 'dec': {}, 'txt': [random_words(rng, args.words) for _ in range(size)]}} for _ in range(n)]
+        return reqs, lambda res: sum([len(s['hyp'][0]['tok'].split()) for s in res['data']])
+    if server == 'whisper':
+        opts = json.dumps({'history': '', 'task': 'transcribe', 'lang': args.lang, 'beam_size': args.beam})
+        reqs = [{'data': (0.1 * rng.standard_normal(int(size * 16000))).astype('<f4').tobytes(), 'headers': {'Content-Type': 'application/octet-stream', 'X-Audio-Format': 'float32', 'X-Whisper-Options': opts}} for _ in range(n)]
+        return reqs, lambda res: len(res['hyp'])
+    instruction = 'You are an expert proofreader. Rewrite the text below only correcting errors, and add paraphrases to the original text.'
+    reqs = [{'json': {'instruction': instruction, 'text': '<txt> {} </txt>'.format(random_words(rng, size)), 'N': args.n, 'structured': args.structured}} for _ in range(n)]
+    if args.structured:
+        return reqs, lambda res: len(res['fix'].split()) + sum([len(p.split()) for p in res['par']])
+    return reqs, lambda res: len(res['hyp'].split())
+
+def replay(client, reqs, count_tokens, concurrency):
+    """ sends reqs from concurrency threads (each one waits for its response before sending the next request), returns the statistics of the run """
+    latencies, tokens, errors = [], [0], [0]
+    lock = threading.Lock()
+    it = iter(reqs)
+
+    def worker():
+        while True:
+            with lock:
+                req = next(it, None)
+            if req is None:
+                return
+            tic = time.time()
+            try:
+                n = count_tokens(client.post(**req))
+            except ClientError as e:
+                logging.warning('Request Error ({}): {}'.format(type(e).__name__, e))
+                with lock:
+                    errors[0] += 1
+                continue
+            with lock:
+                latencies.append(1000*(time.time() - tic))
+                tokens[0] += n
+
+    tic = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for f in [executor.submit(worker) for _ in range(concurrency)]:
+            f.result()
+    elapsed = time.time() - tic
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) if len(latencies) else (None, None, None)
+    return {
+        'requests': len(latencies),
+        'errors': errors[0],
+        'seconds': elapsed,
+        'p50_ms': p50,
+        'p95_ms': p95,
+        'p99_ms': p99,
+        'mean_ms': float(np.mean(latencies)) if len(latencies) else None,
+        'req_per_sec': len(latencies) / elapsed,
+        'tok_per_sec': tokens[0] / elapsed
+    }
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='This script benchmarks a server (latency percentiles, requests/s, tokens/s) under concurrent load. Arguments after -- are passed to the server script.', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('server', type=str, choices=list(SCRIPTS.keys()), help='server to benchmark')
+    parser.add_argument('--url', type=str, help='benchmark this running server rather than starting one with stand-in models (Ex: http://0.0.0.0:5000/translate)', default=None)
+    parser.add_argument('--port', type=int, help='port of the started server (0 for a free port)', default=0)
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS) ### run the server with the stand-in models (benchmark subprocess)
+    group_load = parser.add_argument_group("Load")
+    group_load.add_argument('--concurrency', type=int, nargs='+', help='numbers of concurrent clients', default=[1, 4, 16])
+    group_load.add_argument('--sizes', type=float, nargs='+', help='request sizes: sentences (translate), seconds of audio (whisper), words of text (rewrAIte)', default=None)
+    group_load.add_argument('--requests', type=int, help='number of requests of each run', default=100)
+    group_load.add_argument('--warmup', type=int, help='number of requests sent before each run (not measured)', default=4)
+    group_load.add_argument('--timeout', type=float, help='url request timeout', default=60.0)
+    group_load.add_argument('--seed', type=int, help='seed of the random payloads', default=1234)
+    group_payload = parser.add_argument_group("Payload")
+    group_payload.add_argument('--cfg', type=str, help='translate: cfg of the requests (a stand-in cfg directory is created if not given)', default=None)
+    group_payload.add_argument('--words', type=int, help='translate: words per sentence', default=20)
+    group_payload.add_argument('--lang', type=str, help='whisper: language of the requests (None for detection, which is not batched)', default='en')
+    group_payload.add_argument('--beam', type=int, help='whisper: beam size', default=5)
+    group_payload.add_argument('--n', type=int, help='rewrAIte: number of paraphrases', default=3)
+    group_payload.add_argument('--structured', action='store_true', help='rewrAIte: structured requests (correction then paraphrases in parallel)')
+    group_stand_in = parser.add_argument_group("Stand-in models")
+    group_stand_in.add_argument('--call_ms', type=float, help='cost (msec) of a model call', default=cost['call_ms'])
+    group_stand_in.add_argument('--token_ms', type=float, help='cost (msec) of a decoding step', default=cost['token_ms'])
+    group_stand_in.add_argument('--audio_ms', type=float, help='cost (msec) of a second of audio (whisper)', default=cost['audio_ms'])
+    group_other = parser.add_argument_group("Other")
+    group_other.add_argument('--output', type=str, help='json file with the results (default: benchmark-SERVER.json)', default=None)
+    group_other.add_argument('--server_log', type=str, help='file where the output of the started server is written', default=None)
+    group_other.add_argument('--log', type=str, help='logging level: (verbose) debug, info, warning, error, critical (silent)', default='info')
+    args, server_args = parser.parse_known_args()
+    server_args = [a for a in server_args if a != '--']
+    logging.basicConfig(format='[%(asctime)s.%(msecs)03d] %(levelname)s %(message)s', datefmt='%Y-%m-%d_%H:%M:%S', level=getattr(logging, args.log.upper()), filename=None)
+    cost.update({'call_ms': args.call_ms, 'token_ms': args.token_ms, 'audio_ms': args.audio_ms})
+
+    if args.serve:
+        serve(args.server, args.port, server_args)
+        sys.exit()
+
+    proc = None
+    if args.url is None:
+        if args.server == 'translate' and args.cfg is None:
+            args.cfg = tempfile.mkdtemp(prefix='benchmark-cfg-')
+            for name, config in [('tok_config.json', {'mode': 'conservative'}), ('ct2_config.json', {})]:
+                with open(os.path.join(args.cfg, name), 'w') as f:
+                    json.dump(config, f)
+        port = args.port or free_port()
+        logging.info('starting {} server with stand-in models on port {}'.format(args.server, port))
+        proc = start_server(args.server, port, server_args, args.server_log)
+        args.url = 'http://127.0.0.1:{}{}'.format(port, ROUTES[args.server])
+    if args.sizes is None:
+        args.sizes = {'translate': [1, 16], 'whisper': [1, 5, 10], 'rewrAIte': [10, 40]}[args.server]
+
+    rng = np.random.default_rng(args.seed)
+    client = Client(args.url, timeout=args.timeout, retries=0, pool_size=max(args.concurrency))
+    runs = []
+    try:
+        for size in args.sizes:
+            size = int(size) if args.server != 'whisper' else size
+            for concurrency in args.concurrency:
+                warmup, _ = build_requests(args.server, size, args.warmup, args, rng)
+                replay(client, warmup, lambda res: 0, concurrency)
+                reqs, count_tokens = build_requests(args.server, size, args.requests, args, rng)
+                run = {'size': size, 'concurrency': concurrency, **replay(client, reqs, count_tokens, concurrency)}
+                runs.append(run)
+                logging.info('size={size} concurrency={concurrency} requests={requests} errors={errors} p50={p50_ms:.1f}ms p95={p95_ms:.1f}ms p99={p99_ms:.1f}ms req/s={req_per_sec:.1f} tok/s={tok_per_sec:.1f}'.format(**run) if run['requests'] else 'size={} concurrency={} all requests failed'.format(size, concurrency))
+    finally:
+        client.close()
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+
+    output = args.output or 'benchmark-{}.json'.format(args.server)
+    with open(output, 'w') as f:
+        json.dump({
+            'server': args.server,
+            'url': args.url,
+            'server_args': server_args,
+            'stand_in': {'call_ms': args.call_ms, 'token_ms': args.token_ms, 'audio_ms': args.audio_ms} if proc is not None else None,
+            'requests': args.requests,
+            'runs': runs
+        }, f, indent=2)
+    logging.info('results written to {}'.format(output))
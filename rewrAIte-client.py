@@ -3,13 +3,14 @@ import sys
 import time
 import logging
 import argparse
-from Request import send_request_to_server
+from Client import ClientError
+from Request import send_json_to_server, stream_events_from_server
 
 
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(description='This script calls a rewrAIt server.', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    parser.add_argument('url', type=str, help='server url (Ex: http://0.0.0.0:8001/rewrAIte)')
+    parser.add_argument('url', type=str, help='server url (Ex: http://0.0.0.0:8001/rewrAIte), comma-separated urls of replicas to balance the requests')
     parser.add_argument('--text',     type=str,   help='text to rewrite', required=True)
     parser.add_argument('--lang',     type=str,   help='language of the writer', default='English')
     parser.add_argument('--n',        type=int,   help='number of paraphrases requested', default=3)
@@ -17,6 +18,8 @@ if __name__ == '__main__':
     parser.add_argument('--style',    type=str,   help='style of the writer: Simple, Profesional, Academic, Casual', default='Simple')
     parser.add_argument('--domain',   type=str,   help='domain of the writer: Generic, Medical, Legal, Bank, Technical', default='Generic')
     parser.add_argument('--timeout',  type=float, help='url request timeout', default=10.0)
+    parser.add_argument('--stream',   action='store_true', help='print the output as it is generated')
+    parser.add_argument('--structured', action='store_true', help='generate the correction then the paraphrases in parallel, returned as json')
     group_other = parser.add_argument_group("Other")
     group_other.add_argument('--log', type=str, help='logging level: (verbose) debug, info, warning, error, critical (silent)', default='warning')
     args = parser.parse_args()
@@ -36,10 +39,33 @@ Example:
 
 All your sentences must be grammatically correct and convey the same meaning. Your output does not contain explanations. You write in {args.lang}, with expertise in the {args.domain} domain, using a {args.style} style and a {args.level} rewriting level."""
 
-    res = send_request_to_server(args.url, args.timeout, instruction, text, 10)['hyp']
-    for i,l in enumerate(res.split('\n')):
-        if len(l):
-            print(l)
+    try:
+        req = { 'instruction':instruction, 'text':text, 'N':args.n }
+        if args.structured:
+            req['structured'] = True
+            res = send_json_to_server(args.url, args.timeout, req)
+            print('<fix> ' + res['fix'] + ' </fix>')
+            for p in res['par']:
+                print('<par> ' + p + ' </par>')
+            sys.exit()
+
+        if args.stream:
+            req['stream'] = True
+            printed = ''
+            for event, data in stream_events_from_server(args.url, args.timeout, req):
+                delta = data['text'] if event == 'message' else data['hyp'][len(printed):]
+                printed += delta
+                print(delta, end='', flush=True)
+            print()
+            sys.exit()
+
+        res = send_json_to_server(args.url, args.timeout, req)['hyp']
+        for i,l in enumerate(res.split('\n')):
+            if len(l):
+                print(l)
+    except ClientError as e:
+        logging.error('Request Error ({}): {}'.format(type(e).__name__, e))
+        sys.exit(1)
 
 #Example 2:
 #<txt> Leaders of the world's seven richer nations are expected to agre a plan to use frozen Russian assets to raise money for Ukraine. </txt>
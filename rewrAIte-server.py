@@ -1,27 +1,166 @@
+import re
 import time
+import json
 import logging
 import argparse
+import threading
 import numpy as np
 import ctranslate2
 from transformers import AutoTokenizer
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
+from Batcher import Batcher, BatcherFull
+from Metrics import Counter, Gauge, Histogram, instrument
+from Serving import add_arguments, run as serve
 
-def run(generator, tokenizer, r):
+stage_seconds = Histogram('rewraite_stage_seconds', 'duration (seconds) of the stages of a request: prompt, generate (fix, par when structured), first_token (stream)')
+tokens_total = Counter('rewraite_tokens_total', 'tokens processed: prompt (prefilled), generated')
+prompt_cache_total = Counter('rewraite_prompt_cache_total', 'system prompts requested, by cache result (hit, miss, full: sent as a normal prompt)')
+rejected_total = Counter('rewraite_rejected_total', 'requests rejected (503) because the batcher queue is full')
+model_load_seconds = Gauge('rewraite_model_load_seconds', 'duration (seconds) of the model load: tokenizer, generator')
+
+class Prompts():
+    """
+    Tokenized system blocks ('<s>[INST] <<SYS>>...<</SYS>>') of up to max_size distinct instructions.
+    The system block is given to ctranslate2 as static prompt: the model state after it is computed once and reused, only the text of each request is prefilled.
+    ctranslate2 keeps the state of every static prompt it receives (it cannot be evicted), so only the first max_size distinct instructions are admitted:
+    __call__ returns None for the others, whose whole prompt is tokenized and prefilled on every request (as with max_size=0).
+    """
+    def __init__(self, tokenizer, max_size=32):
+        self.tokenizer = tokenizer
+        self.max_size = max_size
+        self.cache = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, instruction):
+        with self.lock:
+            tokens = self.cache.get(instruction)
+            if tokens is not None:
+                prompt_cache_total.inc(result='hit')
+                return tokens
+            if len(self.cache) >= self.max_size:
+                prompt_cache_total.inc(result='full')
+                return None
+        prompt_cache_total.inc(result='miss')
+        system = f'<s>[INST] <<SYS>>\n{instruction}\n<</SYS>>\n\n'
+        tokens = self.tokenizer.convert_ids_to_tokens(self.tokenizer.encode(system))
+        with self.lock:
+            if instruction not in self.cache and len(self.cache) >= self.max_size: ### filled by concurrent requests meanwhile
+                return None
+            self.cache[instruction] = tokens
+        return tokens
+
+def build_prompt(tokenizer, prompts, r):
+    """
+    Returns the static prompt (tokenized system block, None if prompts are not cached), the prompt tokens and the max_length of the request.
+    The whole prompt is tokenized once and the static prompt is sliced off (tokenizing the text alone would differ: Ex: the SentencePiece dummy prefix),
+    if its first tokens are not the static prompt the whole prompt is used without static prompt
+    """
     instruction = r['instruction']
     text = r['text']
     N = int(r['N'])
-    prompt = f'<s>[INST] <<SYS>>\n{instruction}\n<</SYS>>\n\n{text} [/INST]'
-    tic = time.time()
     max_length = len(tokenizer.encode(text)) * (N+1)
     logging.debug(f"[server] text with {len(tokenizer.encode(text))} tokens, N={N}")
-    prompt_tokens = tokenizer.convert_ids_to_tokens(tokenizer.encode(prompt))
-    logging.debug(f"[server] request: max_length={max_length} prompt={prompt}")
-    results = generator.generate_batch([prompt_tokens], max_length=max_length, include_prompt_in_result=False)
-    output = tokenizer.decode(results[0].sequences_ids[0])
+    static_prompt = prompts(instruction) if prompts is not None and prompts.max_size > 0 else None
+    prompt = f'<s>[INST] <<SYS>>\n{instruction}\n<</SYS>>\n\n{text} [/INST]'
+    tokens = tokenizer.convert_ids_to_tokens(tokenizer.encode(prompt))
+    if static_prompt is not None and tokens[:len(static_prompt)] != static_prompt:
+        logging.debug("[server] prompt tokens do not start with the static prompt of the instruction, not used")
+        static_prompt = None
+    if static_prompt is None:
+        logging.debug(f"[server] request: max_length={max_length} prompt={prompt}")
+        return None, tokens, max_length
+    logging.debug(f"[server] request: max_length={max_length} static_prompt={len(static_prompt)} tokens text={text}")
+    return static_prompt, tokens[len(static_prompt):], max_length
+
+def generate_batch(generator, key, items):
+    """
+    Generates with a single generate_batch call the (prompt_tokens, max_length) items of concurrent requests sharing the same static prompt and decoding options (key).
+    Returns the generated ids of each item (limited to its own max_length)
+    """
+    tic = time.time()
+    static_prompt = list(key[0]) if key[0] is not None else None
+    results = generator.generate_batch([prompt for prompt, _ in items], max_length=max([max_length for _, max_length in items]), include_prompt_in_result=False, static_prompt=static_prompt, **json.loads(key[1]))
+    logging.debug('[server] batch={} time={:.2f}'.format(len(items), time.time()-tic))
+    return [result.sequences_ids[0][:max_length] for result, (_, max_length) in zip(results, items)]
+
+def batch_key(static_prompt, **options):
+    return (tuple(static_prompt) if static_prompt is not None else None, json.dumps(options, sort_keys=True))
+
+def run(batcher, tokenizer, prompts, r):
+    if r.get('structured', False):
+        return run_structured(batcher, tokenizer, prompts, r)
+    tic = time.time()
+    static_prompt, prompt_tokens, max_length = build_prompt(tokenizer, prompts, r)
+    stage_seconds.observe(time.time()-tic, stage='prompt')
+    tokens_total.inc(len(prompt_tokens), kind='prompt')
+    ids = batcher(batch_key(static_prompt), [(prompt_tokens, max_length)])[0]
+    output = tokenizer.decode(ids)
     toc = time.time()
-    logging.debug('[server] response: time={:.2f} length={} output={}'.format(toc-tic, len(results[0].sequences_ids[0]), output))
+    stage_seconds.observe(toc-tic, stage='generate')
+    tokens_total.inc(len(ids), kind='generated')
+    logging.debug('[server] response: time={:.2f} length={} output={}'.format(toc-tic, len(ids), output))
     return {'hyp': output}
 
+def run_structured(batcher, tokenizer, prompts, r):
+    """
+    Generates the correction once (greedy), then the N paraphrases as N samples of a single batched call continuing the prompt after the correction:
+    time depends on the length of one paraphrase rather than N. Returns {'fix': correction, 'par': [paraphrases]}
+    """
+    tic = time.time()
+    N = int(r['N'])
+    static_prompt, prompt_tokens, _ = build_prompt(tokenizer, prompts, r)
+    max_length = 2 * len(tokenizer.encode(r['text'])) + 8 ### one sentence
+    stage_seconds.observe(time.time()-tic, stage='prompt')
+    tokens_total.inc(len(prompt_tokens), kind='prompt')
+    tac = time.time()
+    ids = batcher(batch_key(static_prompt), [(prompt_tokens, max_length)])[0]
+    stage_seconds.observe(time.time()-tac, stage='fix')
+    tokens_total.inc(len(ids), kind='generated')
+    output = tokenizer.decode(ids)
+    m = re.search(r'<fix>(.*?)(</fix>|\n|$)', output, flags=re.DOTALL)
+    fix = (m.group(1) if m else output.split('\n')[0]).strip()
+    logging.debug('[server] fix: time={:.2f} fix={}'.format(time.time()-tic, fix))
+
+    par_tokens = prompt_tokens + tokenizer.convert_ids_to_tokens(tokenizer.encode(f' <fix> {fix} </fix>\n<par>', add_special_tokens=False))
+    options = {'sampling_topk': int(r.get('topk', 10)), 'sampling_temperature': float(r.get('temperature', 0.8))}
+    par = []
+    tac = time.time()
+    outputs = batcher(batch_key(static_prompt, **options), [(par_tokens, max_length)] * N)
+    stage_seconds.observe(time.time()-tac, stage='par')
+    tokens_total.inc(N * len(par_tokens), kind='prompt')
+    tokens_total.inc(sum([len(ids) for ids in outputs]), kind='generated')
+    for ids in outputs:
+        p = tokenizer.decode(ids).split('</par>')[0].split('\n')[0].strip()
+        if len(p) and p not in par:
+            par.append(p)
+    logging.debug('[server] response: time={:.2f} fix={} par={}'.format(time.time()-tic, fix, par))
+    return {'fix': fix, 'par': par}
+
+def run_stream(generator, tokenizer, prompts, r):
+    """
+    Yields Server-Sent Events as tokens are generated: each event contains the text added by the new token, the last one (event: end) contains the whole output
+    """
+    tic = time.time()
+    static_prompt, prompt_tokens, max_length = build_prompt(tokenizer, prompts, r)
+    stage_seconds.observe(time.time()-tic, stage='prompt')
+    tokens_total.inc(len(prompt_tokens), kind='prompt')
+    ids = []
+    output = ''
+    for step in generator.generate_tokens(prompt_tokens, max_length=max_length, static_prompt=static_prompt):
+        if len(ids) == 0:
+            logging.debug('[server] first token after {:.2f} sec'.format(time.time()-tic))
+            stage_seconds.observe(time.time()-tic, stage='first_token')
+        ids.append(step.token_id)
+        text = tokenizer.decode(ids)
+        if len(text) > len(output) and not text.endswith('\ufffd'): ### wait for complete characters
+            yield 'data: {}\n\n'.format(json.dumps({'text': text[len(output):]}))
+            output = text
+    output = tokenizer.decode(ids)
+    stage_seconds.observe(time.time()-tic, stage='generate')
+    tokens_total.inc(len(ids), kind='generated')
+    logging.debug('[server] response: time={:.2f} length={} output={}'.format(time.time()-tic, len(ids), output))
+    yield 'event: end\ndata: {}\n\n'.format(json.dumps({'hyp': output}))
+
     
 if __name__ == '__main__':
 
@@ -33,6 +172,12 @@ if __name__ == '__main__':
     group_model.add_argument('--model_dir', type=str, help='model local directory', default='/nfs/RESEARCH/senellarta/dev/research/ct2-mistral-instruct')
     group_model.add_argument('--compute', type=str, help='compute type: int8, float16, int8_float16', default='float32')
     group_model.add_argument('--device',  type=str, help='device: cpu, cuda, auto', default='auto')    
+    group_model.add_argument('--prefix_cache', type=int, help='number of distinct instructions whose system prompt is cached as ctranslate2 static prompt, further instructions are sent as normal prompts (0 to disable)', default=32)
+    group_batch = parser.add_argument_group("Batching")
+    group_batch.add_argument('--max_batch', type=int, help='maximum number of concurrent requests generated in a batch', default=4)
+    group_batch.add_argument('--max_wait', type=float, help='maximum time (seconds) waiting for concurrent requests to fill a batch', default=0.01)
+    group_batch.add_argument('--max_queue', type=int, help='maximum number of requests waiting to be generated (further requests are rejected with 503)', default=32)
+    add_arguments(parser) ### serving and model workers
     group_other = parser.add_argument_group("Other")
     group_other.add_argument('--log', type=str, help='logging level: (verbose) debug, info, warning, error, critical (silent)', default='info')
     args = parser.parse_args()
@@ -41,16 +186,36 @@ if __name__ == '__main__':
     logging.getLogger('transformers').setLevel(logging.ERROR)    
     logging.getLogger('ctranslate2').setLevel(logging.ERROR)    
     
+    tic = time.time()
     t = AutoTokenizer.from_pretrained(args.model_id)
+    model_load_seconds.set(time.time() - tic, part='tokenizer')
     logging.debug('[server] Loaded tokenizer {}'.format(args.model_id))
     
-    g = ctranslate2.Generator(args.model_dir, device=args.device, compute_type=args.compute)
+    tic = time.time()
+    g = ctranslate2.Generator(args.model_dir, device=args.device, compute_type=args.compute, inter_threads=args.inter_threads, intra_threads=args.intra_threads)
+    model_load_seconds.set(time.time() - tic, part='generator')
     logging.debug('[server] Loaded {}({}, {})'.format(args.model_dir, args.device, args.compute))
+
+    p = Prompts(t, max_size=args.prefix_cache)
+    b = Batcher(lambda key, items: generate_batch(g, key, items), max_size=args.max_batch, max_wait=args.max_wait, max_queue=args.max_queue, workers=args.inter_threads, name='rewrAIte')
         
     app = Flask(__name__)
+    instrument(app, 'rewraite') ### /metrics
     @app.route('/rewrAIte', methods=['POST'])
     def send_data():
-        return jsonify(run(g, t, request.json))
+        r = request.json
+        if r.get('stream', False):
+            return Response(stream_with_context(run_stream(g, t, p, r)), mimetype='text/event-stream')
+        try:
+            return jsonify(run(b, t, p, r))
+        except BatcherFull as e:
+            logging.warning('[server] {}'.format(e))
+            rejected_total.inc()
+            return jsonify({'error': 'server overloaded, retry later'}), 503
+
+    @app.route('/health', methods=['GET'])
+    def health():
+        return jsonify({'status': 'ok'})
     
-    app.run(host=args.host, port=args.port)
+    serve(app, args) ### concurrent requests are gathered by the batcher, whose batches run on inter_threads model workers
 
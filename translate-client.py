@@ -1,24 +1,116 @@
-#import sys
+import os
+import sys
 import time
 import json
+import asyncio
 import logging
 import argparse
-from Request import send_request_to_server
+import itertools
+from Client import AsyncClient, ClientError, HTTPError
+from Request import send_request_to_server, stream_request_to_server
+
+def read_checkpoint(checkpoint):
+    if checkpoint is None or not os.path.isfile(checkpoint):
+        return {'lines': 0, 'bytes': 0}
+    with open(checkpoint, 'r') as f:
+        return json.load(f)
+
+def write_checkpoint(checkpoint, ckpt):
+    tmp = checkpoint + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(ckpt, f)
+    os.replace(tmp, checkpoint) ### atomic
+
+async def translate_file(url, timeout, cfg, dec, input_file, output_file, batch_size, inflight, checkpoint):
+    '''
+    Translates input_file (one sentence per line) into output_file (first hypothesis of each sentence) in requests of batch_size lines, keeping inflight requests running.
+    Lines are read as needed and results written in input order. After each written request the checkpoint file records the number of lines (and bytes of output) done:
+    rerunning the same command after a failure resumes from there.
+    '''
+    ckpt = read_checkpoint(checkpoint)
+    if ckpt['bytes'] and (not os.path.isfile(output_file) or os.path.getsize(output_file) < ckpt['bytes']):
+        logging.warning('{} is missing or shorter than its checkpoint ({} bytes), restarting from the first line'.format(output_file, ckpt['bytes']))
+        ckpt = {'lines': 0, 'bytes': 0}
+    if ckpt['lines']:
+        logging.info('resuming after {} lines'.format(ckpt['lines']))
+    client = AsyncClient(url, max_concurrency=inflight, timeout=timeout)
+    pending = [] ### (number of lines, task) in input order
+    tic = time.time()
+
+    async def write_first(out):
+        n, task = pending.pop(0)
+        res = await task
+        if res.get('statusCode') != 200: ### the server reports errors (Ex: resources unavailable) in the body
+            body = res.get('body', {})
+            if isinstance(body, str):
+                body = json.loads(body)
+            raise HTTPError(res.get('statusCode'), body.get('error', 'no data in response'))
+        for d in res['data']:
+            out.write((d['hyp'][0]['txt'].replace('\n', ' ') + '\n').encode('utf-8'))
+        out.flush()
+        ckpt['lines'] += n
+        ckpt['bytes'] = out.tell()
+        if checkpoint is not None:
+            write_checkpoint(checkpoint, ckpt)
+        logging.info('{} lines done ({:.1f} lines/sec)'.format(ckpt['lines'], ckpt['lines']/(time.time()-tic)))
+
+    with open(input_file, 'r') as f, open(output_file, 'r+b' if ckpt['bytes'] and os.path.isfile(output_file) else 'wb') as out:
+        out.truncate(ckpt['bytes']) ### drop output written after the checkpoint
+        out.seek(ckpt['bytes'])
+        lines = (l.rstrip('\n') for l in itertools.islice(f, ckpt['lines'], None))
+        try:
+            while True:
+                batch = list(itertools.islice(lines, batch_size))
+                if len(batch) == 0:
+                    break
+                if len(pending) >= inflight:
+                    await write_first(out)
+                pending.append((len(batch), asyncio.ensure_future(client.post(json={ 'cfg':cfg, 'dec':dec, 'txt':batch }))))
+            while len(pending):
+                await write_first(out)
+        finally:
+            for _, task in pending:
+                task.cancel()
+            client.close()
 
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(description='This script sends a request to a distant translation server.', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    parser.add_argument('--txt', type=str, nargs='+', help='list of strings to translate', required=True)
+    parser.add_argument('--txt', type=str, nargs='+', help='list of strings to translate (read from stdin, one per line, if not given)', default=None)
     parser.add_argument('--cfg', type=str, help='config resources', default=None)
-    parser.add_argument('--url', type=str, help='server url entry point', default='http://0.0.0.0:5000/translate')
+    parser.add_argument('--url', type=str, help='server url entry point (comma-separated urls of replicas to balance the requests)', default='http://0.0.0.0:5000/translate')
     parser.add_argument('--dec', type=str, help='ctranslate2 decoding options in JSON dictionary (see https://opennmt.net/CTranslate2/python/ctranslate2.Translator.html#ctranslate2.Translator.score_batch for available options)', default='{"beam_size": 5, "num_hypotheses": 1}')
     parser.add_argument('--timeout', type=float, help='url request timeout', default=10.0)
+    parser.add_argument('--stream', action='store_true', help='use the streaming entry point (url + /stream): sentences are sent/received as NDJSON lines, results are printed as they arrive')
+    group_bulk = parser.add_argument_group("Bulk")
+    group_bulk.add_argument('--input', type=str, help='translate this file (one sentence per line) into --output', default=None)
+    group_bulk.add_argument('--output', type=str, help='output file (one translation per line) of --input', default=None)
+    group_bulk.add_argument('--batch', type=int, help='number of lines sent per request', default=64)
+    group_bulk.add_argument('--inflight', type=int, help='number of concurrent requests', default=4)
+    group_bulk.add_argument('--checkpoint', type=str, help='checkpoint file used to resume --input translation (default: --output + .ckpt)', default=None)
     args = parser.parse_args()
     args.dec = json.loads(args.dec)
     logging.basicConfig(format='[%(asctime)s.%(msecs)03d] %(levelname)s %(message)s', datefmt='%Y-%m-%d_%H:%M:%S', level=logging.INFO, filename=None)
 
-    res = send_request_to_server(args.url, args.timeout, args.cfg, args.dec, args.txt)
-    print('res = ' + json.dumps(res, indent=4, ensure_ascii=False))                
+    try:
+        if args.input is not None:
+            if args.output is None:
+                parser.error('--input requires --output')
+            asyncio.run(translate_file(args.url, args.timeout, args.cfg, args.dec, args.input, args.output, args.batch, args.inflight, args.checkpoint or args.output + '.ckpt'))
+            sys.exit()
+
+        txt = args.txt if args.txt is not None else (l.rstrip('\n') for l in sys.stdin)
+
+        if args.stream:
+            for res in stream_request_to_server(args.url, args.timeout, args.cfg, args.dec, txt, path='/stream'):
+                print(json.dumps(res, ensure_ascii=False), flush=True)
+            sys.exit()
+
+        res = send_request_to_server(args.url, args.timeout, args.cfg, args.dec, list(txt))
+        print('res = ' + json.dumps(res, indent=4, ensure_ascii=False))
+    except ClientError as e:
+        logging.error('Request Error ({}): {}'.format(type(e).__name__, e))
+        sys.exit(1)
     #print('conf = ' + json.dumps(res.get('conf', {}), indent=4, ensure_ascii=False))                
     #print('time = ' + json.dumps(res.get('time', {}), indent=4, ensure_ascii=False))                
         
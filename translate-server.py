@@ -3,69 +3,252 @@ import json
 import time
 import logging
 import argparse
+import sqlite3
 import pyonmttok
+import threading
 import ctranslate2
-from flask import Flask, request, jsonify
-from socketserver import ThreadingMixIn
+from collections import OrderedDict
+from flask import Flask, Response, request, jsonify, stream_with_context
+from Batcher import Batcher
+from Metrics import Counter, Gauge, Histogram, instrument
+from Serving import add_arguments, run as serve
+
+stage_seconds = Histogram('translate_stage_seconds', 'duration (seconds) of the pipeline stages of a request: cache, tok, ct2, pos')
+sentences_total = Counter('translate_sentences_total', 'sentences requested, by cache result (hit, miss)')
+tokens_total = Counter('translate_tokens_total', 'tokens translated: source, target (best hypothesis)')
+padding_efficiency = Histogram('translate_padding_efficiency', 'real/padded tokens of the translate_batch calls', buckets=(0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 0.95, 1.0))
+model_loads_total = Counter('translate_model_loads_total', 'cfg models loaded')
+model_load_seconds = Histogram('translate_model_load_seconds', 'duration (seconds) of the model loads: tok, ct2', buckets=(0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0))
+model_evictions_total = Counter('translate_model_evictions_total', 'cfg models evicted from memory')
 
-Tokenizer = None
-Translator = None
-loaded_cfg = None
 logging.basicConfig(format='[%(asctime)s.%(msecs)03d] %(levelname)s %(message)s', datefmt='%Y-%m-%d_%H:%M:%S', level=getattr(logging, 'INFO'), filename=None)
 
 
-def load_models_if_required(cfg):
-    '''                                                                                                                                                                                                                                                         
-    Load tokenizers/ct2_model outside the handler to persist across invocations. Load only if not previously loaded with same cfg                                                                                                                               
+def read_json_config(config_file):
+    if os.path.isfile(config_file):
+        try:
+            with open(config_file, 'r') as file:
+                content = file.read()
+                config = json.loads(content)
+                return config
+        except (json.JSONDecodeError, IOError):
+            return None
+        except Exception:
+            return None
+    return None
+
+def load_models(cfg):
+    '''
+    Load the tokenizer/ct2_model of the cfg directory. Returns the model (None if resources are unavailable), load_tok_time and load_ct2_time
     '''
     load_tok_time = 0.
     load_ct2_time = 0.
 
-    global Tokenizer, Translator, loaded_cfg
-    
-    if cfg is None or not os.path.isdir(cfg) or cfg == loaded_cfg:
-        return load_tok_time, load_ct2_time
+    if cfg is None or not os.path.isdir(cfg):
+        return None, load_tok_time, load_ct2_time
     
     tok_config = os.path.join(cfg, 'tok_config.json')
     ct2_config = os.path.join(cfg, 'ct2_config.json')
-
-    def read_json_config(config_file):
-        if os.path.isfile(config_file):
-            try:
-                with open(config_file, 'r') as file:
-                    content = file.read()
-                    config = json.loads(content)
-                    return config
-            except (json.JSONDecodeError, IOError):
-                return None
-            except Exception:
-                return None
-        return None
-
     config_tok = read_json_config(tok_config)
     config_ct2 = read_json_config(ct2_config)
 
     if config_tok is None or config_ct2 is None:
-        return load_tok_time, load_ct2_time
+        return None, load_tok_time, load_ct2_time
                 
     tic = time.time()
     if 'bpe_model_path' in config_tok: ### the bpe file must be in the cfg directory
         config_tok['bpe_model_path'] = os.path.join(cfg, os.path.basename(config_tok['bpe_model_path']))
     mode = config_tok.pop('mode', 'aggressive')
-    Tokenizer = pyonmttok.Tokenizer(mode, **config_tok)
+    tokenizer = pyonmttok.Tokenizer(mode, **config_tok)
     load_tok_time = 1000*(time.time() - tic)
     logging.info(f'LOAD: msec={load_tok_time} tok_config={tok_config}')
 
     tic = time.time()
     model_path = config_ct2.pop('model_path', None) ### delete it from config
     model_path = cfg ### the model must be in the cfg directory  
-    Translator = ctranslate2.Translator(model_path, **config_ct2)
+    config_ct2.update(ct2_threads) ### model workers set on the command line
+    translator = ctranslate2.Translator(model_path, **config_ct2)
     load_ct2_time = 1000*(time.time() - tic)
     logging.info(f'LOAD: msec={load_ct2_time} ct2_config={ct2_config}')
 
-    loaded_cfg = cfg
-        
-    return load_tok_time, load_ct2_time
+    size = sum([os.path.getsize(os.path.join(cfg, f)) for f in os.listdir(cfg) if os.path.isfile(os.path.join(cfg, f))]) / (1024*1024)
+    model_loads_total.inc()
+    model_load_seconds.observe(load_tok_time / 1000, part='tok')
+    model_load_seconds.observe(load_ct2_time / 1000, part='ct2')
+    return {'cfg': cfg, 'tokenizer': tokenizer, 'translator': translator, 'size': size}, load_tok_time, load_ct2_time
+
+ct2_threads = {} ### inter_threads/intra_threads overriding those of ct2_config.json
+
+
+class Models():
+    '''
+    Tokenizers/ct2_models of several cfg directories kept in memory (loaded outside the handler to persist across invocations).
+    The least recently used model is evicted when more than max_models are loaded or when their size (MB of the cfg directories) exceeds max_memory (0 for no limit).
+    Loads are protected by a lock per cfg (concurrent requests of the same cfg wait for a single load), removed once the load finishes or fails. Evicted models are released once the requests using them finish.
+    '''
+    def __init__(self, max_models=2, max_memory=0):
+        self.max_models = max_models
+        self.max_memory = max_memory
+        self.models = OrderedDict() ### cfg => model
+        self.loading = {} ### cfg => lock
+        self.lock = threading.Lock()
+        self.last_cfg = None ### used by requests without cfg
+
+    def __call__(self, cfg):
+        '''
+        Returns the model of cfg (the last used if cfg is None) loading it if required, and the timing dictionary {load_hit, load_tok, load_ct2}
+        '''
+        times = {'load_hit': True, 'load_tok': 0., 'load_ct2': 0.}
+        with self.lock:
+            if cfg is None:
+                cfg = self.last_cfg
+            if cfg is None:
+                return None, times
+            model = self.hit(cfg)
+            if model is not None:
+                return model, times
+            lock = self.loading.setdefault(cfg, threading.Lock())
+
+        try:
+            with lock:
+                with self.lock:
+                    model = self.hit(cfg) ### loaded by another request meanwhile
+                if model is not None:
+                    return model, times
+                times['load_hit'] = False
+                model, times['load_tok'], times['load_ct2'] = load_models(cfg)
+                if model is None:
+                    return None, times
+                with self.lock:
+                    self.models[cfg] = model
+                    self.last_cfg = cfg
+                    self.evict()
+            return model, times
+        finally:
+            with self.lock:
+                if self.loading.get(cfg) is lock and not lock.locked(): ### not kept for arbitrary (invalid) cfgs
+                    del self.loading[cfg]
+
+    def hit(self, cfg):
+        model = self.models.get(cfg)
+        if model is not None:
+            self.models.move_to_end(cfg)
+            self.last_cfg = cfg
+        return model
+
+    def evict(self):
+        while len(self.models) > 1 and (len(self.models) > self.max_models or (self.max_memory > 0 and sum([m['size'] for m in self.models.values()]) > self.max_memory)):
+            cfg, _ = self.models.popitem(last=False)
+            model_evictions_total.inc()
+            logging.info(f'EVICT: cfg={cfg}')
+
+models = Models()
+Gauge('translate_models_loaded', 'cfg models in memory', fn=lambda: len(models.models))
+Gauge('translate_models_memory_mb', 'size (MB) of the cfg models in memory', fn=lambda: sum([m['size'] for m in list(models.models.values())]))
+
+
+class Cache():
+    '''
+    Sentence translations (data entries) indexed by (cfg, dec options, source sentence).
+    Keeps up to max_size entries in memory (least recently used are evicted), and all entries in the sqlite database db if given (persists across restarts).
+    '''
+    def __init__(self, max_size=10000, db=None):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.db = None
+        if db is not None:
+            self.db = sqlite3.connect(db, check_same_thread=False)
+            self.db.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, data TEXT)')
+
+    def key(self, cfg, dec, txt):
+        return json.dumps([cfg, dec, txt], sort_keys=True, ensure_ascii=False)
+
+    def get(self, keys):
+        ''' returns the list of data entries of keys (None if not found) '''
+        data = []
+        with self.lock:
+            for k in keys:
+                d = self.entries.get(k)
+                if d is not None:
+                    self.entries.move_to_end(k)
+                elif self.db is not None:
+                    row = self.db.execute('SELECT data FROM cache WHERE key=?', (k,)).fetchone()
+                    if row is not None:
+                        d = json.loads(row[0])
+                        self.insert(k, d)
+                data.append(d)
+            n = sum([d is not None for d in data])
+            self.hits += n
+            self.misses += len(data) - n
+        return data
+
+    def put(self, keys, data):
+        with self.lock:
+            for k, d in zip(keys, data):
+                self.insert(k, d)
+            if self.db is not None:
+                self.db.executemany('INSERT OR REPLACE INTO cache VALUES (?, ?)', [(k, json.dumps(d, ensure_ascii=False)) for k, d in zip(keys, data)])
+                self.db.commit()
+
+    def insert(self, k, d):
+        if self.max_size <= 0:
+            return
+        self.entries[k] = d
+        self.entries.move_to_end(k)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / max(self.hits + self.misses, 1)}
+
+cache = Cache()
+Gauge('translate_cache_entries', 'sentence translations cached in memory', fn=lambda: len(cache.entries))
+
+
+def buckets(lengths, max_tokens, max_size):
+    '''
+    Returns the list of buckets (lists of indexs of lengths) of sentences with similar length: indexs are sorted by length and
+    a bucket is closed when it reaches max_size sentences or when its padded size (sentences x longest length) would exceed max_tokens
+    '''
+    result = []
+    bucket = []
+    for i in sorted(range(len(lengths)), key=lambda i: lengths[i]):
+        if len(bucket) and (len(bucket) >= max_size or (len(bucket)+1) * max(lengths[i], 1) > max_tokens):
+            result.append(bucket)
+            bucket = []
+        bucket.append(i)
+    if len(bucket):
+        result.append(bucket)
+    return result
+
+def translate_batch(key, items):
+    '''
+    Translates the (model, tok) items of concurrent requests sharing the same cfg and dec options (key).
+    Items are translated in buckets of similar length (reduces padding) and returned in their original order, each with the padding efficiency (real/padded tokens) of the batch
+    '''
+    _, dec = key
+    model = items[0][0]
+    tok = [t for _, t in items]
+    lengths = [len(t) for t in tok]
+    trn = [None] * len(tok)
+    real, padded = 0, 0
+    for bucket in buckets(lengths, bucket_tokens, bucket_size):
+        res = model['translator'].translate_batch([tok[i] for i in bucket], **json.loads(dec))
+        for i, r in zip(bucket, res):
+            trn[i] = r
+        real += sum([lengths[i] for i in bucket])
+        padded += len(bucket) * max([lengths[i] for i in bucket])
+    pad_eff = real / padded if padded else 1.0
+    padding_efficiency.observe(pad_eff)
+    return [(r, pad_eff) for r in trn]
+
+bucket_tokens = 4096
+bucket_size = 64
+
+batcher = Batcher(translate_batch, max_size=1024, max_wait=0.01, size=lambda item: len(item[1]), name='translate') ### configured by the command line (defaults when loaded by gunicorn)
 
 def run(r):
     start_time = 1000*time.time()
@@ -84,7 +267,7 @@ def run(r):
             })
         }
 
-    if loaded_cfg is None and cfg is None:
+    if models.last_cfg is None and cfg is None:
         logging.info(f'Error: missing cfg parameter in request')
         return {
             'statusCode': 400,
@@ -94,11 +277,9 @@ def run(r):
             })
         }
     
-    load_tok_time, load_ct2_time = load_models_if_required(cfg)
-    
-    global Tokenizer, Translator
+    model, load_times = models(cfg)
     
-    if Tokenizer is None or Translator is None:
+    if model is None:
         logging.info(f'error: resources unavailable')
         return {
             'statusCode': 400,
@@ -108,77 +289,211 @@ def run(r):
             }
         }
     
-    tic = time.time()
-    tok, _ = Tokenizer.tokenize_batch(txt)
-    assert len(tok) == len(txt)
-    tok_time = 1000*(time.time() - tic)
-    logging.info(f'tok={tok_time} ms')
-    
-
-    tic = time.time()
-    trn = Translator.translate_batch(tok, **dec)
-    assert len(trn) == len(tok)
-    ct2_time = 1000*(time.time() - tic)
-    logging.info(f'ct2={ct2_time} ms')
-
-    tic = time.time()
-    data = []
-    for i in range(len(trn)):
-        hyp = []
-        for j in range(len(trn[i].hypotheses)):
-            hyp.append({
-                'txt': Tokenizer.detokenize(trn[i].hypotheses[j]),
-                'tok': ' '.join(trn[i].hypotheses[j]),
-                'score': trn[i].scores[j] if len(trn[i].scores)>i else None,
-                'attention': trn[i].attention[j] if len(trn[i].attention)>j else None
-            })
-        data.append({
-            'txt': txt[i],
-            'tok': ' '.join(tok[i]),
-            'hyp': hyp
-        })
-    pos_time = 1000*(time.time() - tic)
-    logging.info(f'pos={pos_time} ms')
-    logging.info(f'DATA: {data}')
+    data, times = translate_sentences(model, txt, dec)
 
     return {
         'statusCode': 200,
         "data": data,
         "conf": {
-            "cfg": loaded_cfg,
-            "dec": dec
+            "cfg": model['cfg'],
+            "dec": dec,
+            "cache": cache.stats()
         },
         "time": {
-            "load_tok": load_tok_time,
-            "load_ct2": load_ct2_time,
-            "tok": tok_time,
-            "ct2": ct2_time,
-            "pos": pos_time
+            "load_hit": load_times['load_hit'],
+            "load_tok": load_times['load_tok'],
+            "load_ct2": load_times['load_ct2'],
+            **times
         }
     }
+
+def translate_sentences(model, txt, dec):
+    '''
+    Translates the list of sentences txt: sentences found in cache are not translated, the others are tokenized/translated/detokenized and added to the cache.
+    Returns the data (in the order of txt) and the timing dictionary
+    '''
+    tic = time.time()
+    keys = [cache.key(model['cfg'], dec, t) for t in txt]
+    data = cache.get(keys)
+    miss = list(OrderedDict.fromkeys([t for t, d in zip(txt, data) if d is None])) ### unique sentences not found
+    hits = sum([d is not None for d in data])
+    cache_time = 1000*(time.time() - tic)
+    logging.info(f'cache={cache_time} ms hit={hits} miss={len(txt)-hits}')
+    stage_seconds.observe(cache_time / 1000, stage='cache')
+    sentences_total.inc(hits, cache='hit')
+    sentences_total.inc(len(txt) - hits, cache='miss')
+
+    tok_time, ct2_time, pos_time, pad_eff = 0., 0., 0., 1.
+    if len(miss):
+        tic = time.time()
+        tok, _ = model['tokenizer'].tokenize_batch(miss)
+        assert len(tok) == len(miss)
+        tok_time = 1000*(time.time() - tic)
+        logging.info(f'tok={tok_time} ms')
+        stage_seconds.observe(tok_time / 1000, stage='tok')
+        tokens_total.inc(sum([len(t) for t in tok]), side='source')
+
+        tic = time.time()
+        res = batcher((model['cfg'], json.dumps(dec, sort_keys=True)), [(model, t) for t in tok])
+        assert len(res) == len(tok)
+        trn = [r for r, _ in res]
+        pad_eff = sum([e for _, e in res]) / len(res)
+        ct2_time = 1000*(time.time() - tic)
+        logging.info(f'ct2={ct2_time} ms pad_eff={pad_eff:.2f}')
+        stage_seconds.observe(ct2_time / 1000, stage='ct2')
+        tokens_total.inc(sum([len(t.hypotheses[0]) for t in trn if len(t.hypotheses)]), side='target')
+
+        tic = time.time()
+        translated = {}
+        for i in range(len(trn)):
+            hyp = []
+            for j in range(len(trn[i].hypotheses)):
+                hyp.append({
+                    'txt': model['tokenizer'].detokenize(trn[i].hypotheses[j]),
+                    'tok': ' '.join(trn[i].hypotheses[j]),
+                    'score': trn[i].scores[j] if len(trn[i].scores)>i else None,
+                    'attention': trn[i].attention[j] if len(trn[i].attention)>j else None
+                })
+            translated[miss[i]] = {
+                'txt': miss[i],
+                'tok': ' '.join(tok[i]),
+                'hyp': hyp
+            }
+        cache.put([cache.key(model['cfg'], dec, t) for t in miss], [translated[t] for t in miss])
+        data = [d if d is not None else translated[t] for t, d in zip(txt, data)]
+        pos_time = 1000*(time.time() - tic)
+        logging.info(f'pos={pos_time} ms')
+        stage_seconds.observe(pos_time / 1000, stage='pos')
+    logging.info(f'DATA: {data}')
+
+    return data, {
+        "cache": cache_time,
+        "cache_hit": hits,
+        "cache_miss": len(txt) - hits,
+        "tok": tok_time,
+        "ct2": ct2_time,
+        "pad_eff": pad_eff,
+        "pos": pos_time
+    }
         
-class ThreadedFlaskServer(ThreadingMixIn, Flask): #this class is for multithreading
-    pass
+def run_stream(lines, batch_size):
+    '''
+    Translates the NDJSON lines of a request in batches of batch_size sentences, yields the NDJSON lines of the response as each batch finishes.
+    Each request line is a json object with a sentence to translate {"txt": "..."}, the first line may also contain the cfg and dec options.
+    Each response line contains the data of a sentence (in input order), the last line contains the conf and time of the whole stream (or the error).
+    '''
+    start_time = 1000*time.time()
+    model, load_times, dec = None, None, {}
+    times = {}
+    pad_eff = [] ### (pad_eff, sentences) of each batch
+    n = 0
+
+    def error(msg):
+        logging.info(f'Error: {msg}')
+        return json.dumps({"error": msg, "msec": 1000*time.time() - start_time}) + '\n'
 
-#app = Flask(__name__) #without multithreading
-app = ThreadedFlaskServer(__name__) #with multithreading
+    def flush(batch):
+        data, t = translate_sentences(model, batch, dec)
+        pad_eff.append((t.pop('pad_eff'), len(batch))) ### a ratio: averaged over the sentences of the stream, not summed
+        for k, v in t.items():
+            times[k] = times.get(k, 0) + v
+        return ''.join([json.dumps(d, ensure_ascii=False) + '\n' for d in data])
+
+    batch = []
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            r = json.loads(line)
+        except json.JSONDecodeError as e:
+            yield error(f'invalid json line: {e}')
+            return
+        if model is None:
+            dec = r.get('dec', {})
+            logging.info(f"REQ STREAM: cfg={r.get('cfg')} dec={dec}")
+            model, load_times = models(r.get('cfg', None))
+            if model is None:
+                yield error('resources unavailable')
+                return
+        if 'txt' not in r:
+            continue
+        batch += r['txt'] if isinstance(r['txt'], list) else [r['txt']]
+        while len(batch) >= batch_size:
+            yield flush(batch[:batch_size])
+            n += batch_size
+            batch = batch[batch_size:]
+    if model is None:
+        yield error('missing cfg/txt parameters in request')
+        return
+    if len(batch):
+        yield flush(batch)
+        n += len(batch)
+    yield json.dumps({
+        "conf": {
+            "cfg": model['cfg'],
+            "dec": dec,
+            "cache": cache.stats()
+        },
+        "time": {
+            "load_hit": load_times['load_hit'],
+            "load_tok": load_times['load_tok'],
+            "load_ct2": load_times['load_ct2'],
+            "total": 1000*time.time() - start_time,
+            **times,
+            "pad_eff": sum([e*k for e, k in pad_eff]) / sum([k for _, k in pad_eff]) if len(pad_eff) else 1.0
+        },
+        "n": n
+    }) + '\n'
+
+stream_batch = 64
+
+app = Flask(__name__) ### concurrent requests are handled by the threads of the server (see Serving)
+instrument(app, 'translate') ### /metrics
 @app.route('/translate', methods=['POST'])
 def translate():
     return jsonify(run(request.json))
 
+@app.route('/translate/stream', methods=['POST'])
+def translate_stream():
+    return Response(stream_with_context(run_stream(request.stream, stream_batch)), mimetype='application/x-ndjson')
+
+@app.route('/health', methods=['GET'])
+def health():
+    return jsonify({'status': 'ok'})
+
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(description='Description.', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('--host', type=str, help='Host used (use 0.0.0.0 to allow distant access, otherwise use 127.0.0.1)', default='0.0.0.0')
     parser.add_argument('--port', type=int, help='Port used in local server', default=5000)
     parser.add_argument('--cfg',  type=str, help='Load model when launching', default=None)
+    parser.add_argument('--max_models', type=int, help='maximum number of cfg models kept in memory (least recently used are evicted)', default=2)
+    parser.add_argument('--max_memory', type=float, help='maximum size (MB) of the cfg models kept in memory (0 for no limit)', default=0)
+    parser.add_argument('--max_batch_tokens', type=int, help='maximum number of source tokens of concurrent requests translated in a batch', default=1024)
+    parser.add_argument('--max_wait', type=float, help='maximum time (seconds) waiting for concurrent requests to fill a batch', default=0.01)
+    parser.add_argument('--cache_size', type=int, help='maximum number of sentence translations cached in memory (0 to disable)', default=10000)
+    parser.add_argument('--cache_db', type=str, help='sqlite file where sentence translations are also cached (persists across restarts)', default=None)
+    parser.add_argument('--bucket_tokens', type=int, help='maximum number of (padded) tokens of a translate_batch call, sentences are bucketed by length', default=4096)
+    parser.add_argument('--bucket_size', type=int, help='maximum number of sentences of a translate_batch call', default=64)
+    parser.add_argument('--stream_batch', type=int, help='number of sentences translated at once by the streaming entry point (/translate/stream)', default=64)
+    add_arguments(parser) ### serving and model workers
     args = parser.parse_args()
 
+    stream_batch = args.stream_batch
+    bucket_tokens = args.bucket_tokens
+    bucket_size = args.bucket_size
+    cache = Cache(max_size=args.cache_size, db=args.cache_db)
+    batcher.configure(max_size=args.max_batch_tokens, max_wait=args.max_wait, workers=args.inter_threads)
+    if args.inter_threads > 1 or args.intra_threads > 0:
+        ct2_threads.update({'inter_threads': args.inter_threads, 'intra_threads': args.intra_threads})
+
+    models.max_models = args.max_models
+    models.max_memory = args.max_memory
     if args.cfg is not None:
-        _, _ = load_models_if_required(args.cfg)
+        _, _ = models(args.cfg)
     
     #You can run Flask directly using this script (for development), Ex: python translate-server.py
     #or run app class with gunicorn (loads the app object, not main), Ex: gunicorn -w 1 --threads 100 translate-server:app -b 0.0.0.0:5000
 
-    app.run(host=args.host, port=args.port, threaded=True) #threaded allows multithreading
+    serve(app, args) ### batches of concurrent requests run on inter_threads model workers
 
@@ -3,17 +3,19 @@ import time
 import logging
 import argparse
 from Streamer import Streamer
+from Client import ClientError
 
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(description='This script reads audio data from the available microphone (or wav/mp3 file) and performs (or simulates) ASR/ST using a Whisper server.', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    parser.add_argument('url', type=str, help='server url (Ex: http://0.0.0.0:8000/whisper)')
+    parser.add_argument('url', type=str, help='server url (Ex: http://0.0.0.0:8000/whisper), comma-separated urls of replicas to balance the requests')
     group_audio = parser.add_argument_group("Audio")    
     group_audio.add_argument('--channels', type=int, help='channels: 1 (mono), 2 (stereo)', default=1)
     group_audio.add_argument('--srate', type=int, help='sample rate', default=16000)
     group_audio.add_argument('--block', type=int, help='size of audio block stored', default=4096)
     group_audio.add_argument('--file', type=str, help='stream this wav/mp3 file rather than microphone', default=None)
     group_audio.add_argument('--play', action='store_true', help='play audio while streaming file')
+    group_audio.add_argument('--offline', action='store_true', help='stream file faster than real time (simulated capture clock, no sound device), --every seconds of audio per request')
     group_stream = parser.add_argument_group("Stream")    
     group_stream.add_argument('--task', type=str, help='task to perform: transcribe, translate', default='transcribe')
     group_stream.add_argument('--lang', type=str, help='force language', default=None)
@@ -22,6 +24,15 @@ if __name__ == '__main__':
     group_stream.add_argument('--max_segment_time', type=float, help='segment larger than this amount of words are forced to confirm', default=6.0)
     group_stream.add_argument('--min_common_words', type=int, help='minimum number of common words to confirm a prefix', default=2)
     group_stream.add_argument('--min_remain_words', type=int, help='minimum number of remaining words after confirmed prefix', default=1)
+    group_stream.add_argument('--json', action='store_true', help='send audio in JSON requests (for old servers) rather than binary PCM')
+    group_stream.add_argument('--max_inflight', type=int, help='maximum number of requests in flight (windows waiting for a request are superseded by newer ones)', default=1)
+    group_stream.add_argument('--adaptive', action='store_true', help='adapt the delay between transcriptions (--every) to the measured server latency')
+    group_stream.add_argument('--min_every', type=float, help='minimum delay (seconds) between transcriptions when --adaptive', default=0.25)
+    group_stream.add_argument('--max_every', type=float, help='maximum delay (seconds) between transcriptions when --adaptive', default=5.0)
+    group_stream.add_argument('--history_words', type=int, help='number of last confirmed words sent as prompt (history) of the next request', default=50)
+    group_stream.add_argument('--gate_db', type=float, help='RMS level (dBFS) under which audio is silence: requests are skipped while no speech arrives and leading silence is not sent (Ex: -45), None to disable', default=None)
+    group_stream.add_argument('--no_session', action='store_true', help='send the whole unconfirmed audio on every request rather than streaming new samples to a server session')
+    group_stream.add_argument('--pcm', type=str, help='binary PCM sample format: float32, int16', default='float32')
     group_stream.add_argument('--timeout', type=int, help='url request timeout', default=10.0)
     group_other = parser.add_argument_group("Other")
     group_other.add_argument('--log', type=str, help='logging level: (verbose) debug, info, warning, error, critical (silent)', default='warning')
@@ -44,6 +55,16 @@ if __name__ == '__main__':
         min_remain_words=args.min_remain_words,
         max_segment_time=args.max_segment_time,
         play=args.play,
+        binary=not args.json,
+        dtype=args.pcm,
+        session=not args.no_session,
+        offline=args.offline,
+        gate_db=args.gate_db,
+        history_words=args.history_words,
+        max_inflight=args.max_inflight,
+        adaptive=args.adaptive,
+        min_every=args.min_every,
+        max_every=args.max_every,
     )
     
     #logging.info('Processing... use [Ctrl+c] to terminate streaming')
@@ -56,6 +77,9 @@ if __name__ == '__main__':
         s()
     except KeyboardInterrupt:
         logging.info('KeyboardInterrupt')
+    except ClientError as e:
+        logging.error('Request Error ({}): {}'.format(type(e).__name__, e))
+        sys.exit(1)
     #logging.info('Done, audio duration={:.2f} sec'.format(time.time()-tic))
     #print('Done, audio duration={:.2f} sec'.format(time.time()-tic), file=sys.stderr)
 
@@ -0,0 +1,107 @@
+import sys
+import json
+import bisect
+import time
+import logging
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from faster_whisper.audio import decode_audio
+import numpy as np
+from faster_whisper.vad import VadOptions, get_speech_timestamps
+from Client import Client, ClientError
+from Streamer import send_audio_to_server
+
+def speech_chunks(audio, samplerate=16000, max_chunk=30.0, min_silence=0.5, pad=0.2):
+    """
+    Returns the chunks of audio to transcribe, each one the list of the (start, end) sample positions of its speech segments: segments found by the VAD
+    are grouped while their speech does not exceed max_chunk seconds (the VAD splits segments longer than max_chunk). Only the speech of a chunk is sent
+    (see transcribe_chunks), the silence between its segments is not
+    """
+    opts = VadOptions(max_speech_duration_s=max_chunk, min_silence_duration_ms=int(min_silence*1000), speech_pad_ms=int(pad*1000))
+    chunks = []
+    for s in get_speech_timestamps(audio, opts, sampling_rate=samplerate):
+        if len(chunks) and sum([e - b for b, e in chunks[-1]]) + s['end'] - s['start'] <= max_chunk * samplerate:
+            chunks[-1].append((s['start'], s['end']))
+        else:
+            chunks.append([(s['start'], s['end'])])
+    return chunks
+
+def restore_times(hyp, segments):
+    """ maps the word positions of hyp (samples in the concatenated speech of segments) back to absolute sample positions of the audio """
+    offsets = np.cumsum([0] + [e - s for s, e in segments]) ### position of each segment in the concatenated speech
+    for w in hyp:
+        i = min(max(bisect.bisect_right(offsets, (w['start'] + w['end']) // 2) - 1, 0), len(segments) - 1) ### segment of the middle of the word
+        start, end = segments[i]
+        w['start'] = min(max(start + w['start'] - int(offsets[i]), start), end)
+        w['end'] = min(max(start + w['end'] - int(offsets[i]), start), end)
+    return hyp
+
+def transcribe_chunks(client, audio, chunks, task, lang, beam_size, samplerate, workers=8, binary=True, dtype='float32'):
+    """
+    Transcribes the chunks with up to workers concurrent requests (spread over the replicas of client): the speech segments of a chunk are concatenated.
+    Returns the server answer of each chunk (in the order of chunks), with word start/end as absolute sample positions of audio
+    """
+    def transcribe(chunk):
+        tic = time.time()
+        speech = np.concatenate([audio[s:e] for s, e in chunk])
+        out = send_audio_to_server(client, speech, '', task, lang, beam_size, 0, samplerate, binary=binary, dtype=dtype)
+        restore_times(out['hyp'], chunk)
+        logging.info('chunk [{:.2f}-{:.2f}] ({:.2f} sec of speech) transcribed in {:.2f} sec ({} words)'.format(chunk[0][0]/samplerate, chunk[-1][1]/samplerate, len(speech)/samplerate, time.time()-tic, len(out['hyp'])))
+        return out
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(transcribe, chunks))
+
+def timestamp(seconds):
+    return '{:02d}:{:02d}:{:05.2f}'.format(int(seconds // 3600), int(seconds % 3600 // 60), seconds % 60)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='This script transcribes a (long) wav/mp3 file: speech chunks found by VAD are transcribed concurrently by Whisper servers and stitched into a single timeline.', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('url', type=str, help='server url (Ex: http://0.0.0.0:8000/whisper), comma-separated urls of replicas to balance the requests')
+    parser.add_argument('--file', type=str, help='wav/mp3 file to transcribe', required=True)
+    parser.add_argument('--output', type=str, help='json file with the chunks and the words (times in seconds) of the transcription', default=None)
+    group_audio = parser.add_argument_group("Audio")
+    group_audio.add_argument('--srate', type=int, help='sample rate', default=16000)
+    group_audio.add_argument('--max_chunk', type=float, help='maximum duration (seconds) of the chunks sent to the server', default=30.0)
+    group_audio.add_argument('--min_silence', type=float, help='minimum duration (seconds) of the silences where chunks are cut', default=0.5)
+    group_transcribe = parser.add_argument_group("Transcription")
+    group_transcribe.add_argument('--task', type=str, help='task to perform: transcribe, translate', default='transcribe')
+    group_transcribe.add_argument('--lang', type=str, help='force language (chunks of the same language are batched by the server)', default=None)
+    group_transcribe.add_argument('--beam', type=int, help='beam size', default=5)
+    group_transcribe.add_argument('--workers', type=int, help='number of concurrent requests', default=8)
+    group_transcribe.add_argument('--json', action='store_true', help='send audio in JSON requests (for old servers) rather than binary PCM')
+    group_transcribe.add_argument('--pcm', type=str, help='binary PCM sample format: float32, int16', default='float32')
+    group_transcribe.add_argument('--timeout', type=float, help='url request timeout', default=60.0)
+    group_other = parser.add_argument_group("Other")
+    group_other.add_argument('--log', type=str, help='logging level: (verbose) debug, info, warning, error, critical (silent)', default='warning')
+    args = parser.parse_args()
+    logging.basicConfig(format='[%(asctime)s.%(msecs)03d] %(levelname)s %(message)s', datefmt='%Y-%m-%d_%H:%M:%S', level=getattr(logging, args.log.upper()), filename=None)
+
+    tic = time.time()
+    audio = decode_audio(args.file, sampling_rate=args.srate)
+    chunks = speech_chunks(audio, samplerate=args.srate, max_chunk=args.max_chunk, min_silence=args.min_silence)
+    logging.info('{:.2f} sec of audio, {} chunks with {:.2f} sec of speech'.format(len(audio)/args.srate, len(chunks), sum([e-s for chunk in chunks for s, e in chunk])/args.srate))
+
+    client = Client(args.url, timeout=args.timeout, pool_size=args.workers)
+    try:
+        outs = transcribe_chunks(client, audio, chunks, args.task, args.lang, args.beam, args.srate, workers=args.workers, binary=not args.json, dtype=args.pcm)
+    except ClientError as e:
+        logging.error('Request Error ({}): {}'.format(type(e).__name__, e))
+        sys.exit(1)
+    finally:
+        client.close()
+
+    for chunk, out in zip(chunks, outs):
+        print('[{} - {}] {}'.format(timestamp(chunk[0][0]/args.srate), timestamp(chunk[-1][1]/args.srate), ''.join([w['word'] for w in out['hyp']]).strip()))
+    elapsed = time.time() - tic
+    print('Done, {:.2f} sec of audio in {:.2f} sec (x{:.1f} real time)'.format(len(audio)/args.srate, elapsed, len(audio)/args.srate/max(elapsed, 1e-6)), file=sys.stderr)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'file': args.file,
+                'chunks': [{'start': chunk[0][0]/args.srate, 'end': chunk[-1][1]/args.srate, 'speech': [{'start': s/args.srate, 'end': e/args.srate} for s, e in chunk], 'lang': out['lang'], 'langP': out['langP'], 'text': ''.join([w['word'] for w in out['hyp']]).strip()} for chunk, out in zip(chunks, outs)],
+                'words': [{'start': w['start']/args.srate, 'end': w['end']/args.srate, 'word': w['word'], 'wordP': w['wordP']} for out in outs for w in out['hyp']]
+            }, f, indent=2, ensure_ascii=False)
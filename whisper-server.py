@@ -1,15 +1,60 @@
+import re
 import time
+import json
+import uuid
+import bisect
 import logging
 import argparse
+import threading
 import numpy as np
+import faster_whisper
 from faster_whisper import WhisperModel
+from faster_whisper.vad import get_speech_timestamps
 from flask import Flask, request, jsonify
+from AudioBuffer import AudioBuffer
+from Batcher import Batcher
+from Metrics import Counter, Gauge, Histogram, instrument
+from Serving import add_arguments, run as serve
+try:
+    from faster_whisper import BatchedInferencePipeline ### faster_whisper >= 1.1
+except ImportError:
+    BatchedInferencePipeline = None
+### clip_timestamps of BatchedInferencePipeline.transcribe are sample indices in faster_whisper 1.1.x, seconds since 1.2
+CLIP_SAMPLES = tuple([int(x) for x in re.findall(r'\d+', getattr(faster_whisper, '__version__', '1.2'))[:2]]) < (1, 2)
 
-def run(model, r): 
-    logging.debug("[server] request: history={} task={}, lang={}, beam_size={} len(audio)={}".format(r['history'], r['task'], r['lang'], r['beam_size'], len(r['audio'])))
+transcribe_seconds = Histogram('whisper_transcribe_seconds', 'duration (seconds) of the transcriptions: single (one request) or batched')
+window_seconds = Histogram('whisper_audio_window_seconds', 'seconds of audio transcribed per request', buckets=(0.5, 1.0, 2.0, 3.0, 5.0, 7.5, 10.0, 15.0, 20.0, 30.0))
+audio_seconds_total = Counter('whisper_audio_seconds_total', 'seconds of audio transcribed')
+words_total = Counter('whisper_words_total', 'words transcribed')
+sessions_expired_total = Counter('whisper_sessions_expired_total', 'streaming sessions closed after timeout')
+lang_requests_total = Counter('whisper_session_lang_requests_total', 'session requests by origin of the language: client (given), pinned (detection skipped), detected')
+model_load_seconds = Gauge('whisper_model_load_seconds', 'duration (seconds) of the model load')
+
+def read_request(req):
+    """
+    Returns the audio (float32 numpy array) and the options of the request, either:
+    - binary: the body contains raw little-endian PCM (X-Audio-Format: float32 or int16) and the options are json-encoded in the X-Whisper-Options header
+    - json: the body contains the options and the audio as a list of floats (old clients)
+    """
+    if req.is_json:
+        r = req.get_json()
+        audio = np.asarray(r.pop('audio'), dtype=np.float32)
+        return audio, r
+    r = json.loads(req.headers.get('X-Whisper-Options', '{}'))
+    dtype = req.headers.get('X-Audio-Format', 'float32')
+    if dtype == 'int16':
+        audio = np.frombuffer(req.get_data(), dtype='<i2').astype(np.float32) / 32768.0
+    elif dtype == 'float32':
+        audio = np.frombuffer(req.get_data(), dtype='<f4') ### no copy
+    else:
+        raise ValueError('unsupported X-Audio-Format: {}'.format(dtype))
+    return audio, r
+
+def run(model, audio, r): 
+    logging.debug("[server] request: history={} task={}, lang={}, beam_size={} len(audio)={}".format(r['history'], r['task'], r['lang'], r['beam_size'], len(audio)))
     tic = time.time()
     segments, info = model.transcribe(
-        np.asarray(r['audio'], dtype=np.float32),
+        audio,
         language=r['lang'],
         task=r['task'],
         beam_size=int(r['beam_size']),
@@ -23,10 +68,148 @@ def run(model, r):
             hyp.append({'start':word.start, 'end':word.end, 'word':word.word, 'wordP':word.probability})
     out = {'lang': info.language, 'langP': info.language_probability, 'hyp': hyp}
     toc = time.time()
-    logging.info('[server] len(audio)={} ntoks={} time={:.2f} time_per_tok={:.2f}'.format(len(r['audio']), len(hyp), toc-tic, (toc-tic)/len(hyp) if len(hyp) else 0))
+    transcribe_seconds.observe(toc-tic, mode='single')
+    window_seconds.observe(len(audio) / 16000)
+    audio_seconds_total.inc(len(audio) / 16000)
+    words_total.inc(len(hyp))
+    logging.info('[server] len(audio)={} ntoks={} time={:.2f} time_per_tok={:.2f}'.format(len(audio), len(hyp), toc-tic, (toc-tic)/len(hyp) if len(hyp) else 0))
     logging.debug('[server] answer: {} took {:.2f} sec'.format(out, toc-tic))
     return out
 
+def batch_key(r):
+    """
+    Requests with the same task/lang/beam_size are transcribed together. Requests without lang need their own language detection and requests
+    with history need their own prompt: they are not batched
+    """
+    if r['lang'] is None or r['history']:
+        return uuid.uuid4().hex
+    return (r['task'], r['lang'], int(r['beam_size']))
+
+def run_batch(model, pipeline, key, items, samplerate=16000):
+    """
+    Transcribes the (audio, r) items sharing the same key.
+    Several items are transcribed with a single batched inference: their audio are concatenated (separated by silence) and their voiced regions
+    (as filtered by vad_filter in the single path) are decoded as clips of the BatchedInferencePipeline, then words are assigned back to their item.
+    Items have no history (see batch_key).
+    """
+    if len(items) == 1 or pipeline is None:
+        return [run(model, audio, r) for audio, r in items]
+    task, lang, beam_size = key
+    tic = time.time()
+    gap = np.zeros(samplerate // 2, dtype=np.float32)
+    chunks, clips, starts, n = [], [], [], 0
+    for audio, _ in items:
+        starts.append(n / samplerate)
+        for speech in get_speech_timestamps(audio, max_speech_duration_s=30): ### clips longer than 30 seconds are not decoded entirely
+            s, e = n + speech['start'], n + speech['end']
+            clips.append({'start': s, 'end': e} if CLIP_SAMPLES else {'start': s / samplerate, 'end': e / samplerate})
+        chunks += [audio, gap]
+        n += len(audio) + len(gap)
+    if len(clips) == 0: ### no speech in any item
+        return [{'lang': lang, 'langP': 1.0, 'hyp': []} for _ in items]
+    segments, info = pipeline.transcribe(
+        np.concatenate(chunks),
+        language=lang,
+        task=task,
+        beam_size=beam_size,
+        vad_filter=False,
+        clip_timestamps=clips,
+        word_timestamps=True,
+        batch_size=len(items)
+    )
+    outs = [{'lang': info.language, 'langP': info.language_probability, 'hyp': []} for _ in items]
+    for segment in segments:
+        i = max(bisect.bisect_right(starts, segment.start + 0.25) - 1, 0) ### tolerance of half the gap
+        for word in segment.words:
+            outs[i]['hyp'].append({'start':word.start-starts[i], 'end':word.end-starts[i], 'word':word.word, 'wordP':word.probability})
+    toc = time.time()
+    transcribe_seconds.observe(toc-tic, mode='batched')
+    for audio, _ in items:
+        window_seconds.observe(len(audio) / samplerate)
+        audio_seconds_total.inc(len(audio) / samplerate)
+    words_total.inc(sum([len(out['hyp']) for out in outs]))
+    logging.info('[server] batch={} len(audio)={} ntoks={} time={:.2f}'.format(len(items), n, sum([len(out['hyp']) for out in outs]), toc-tic))
+    return outs
+
+class Sessions():
+    """
+    Streaming sessions: each session keeps the audio not yet confirmed by its client, which only uploads new samples.
+    Sessions not used during timeout seconds are closed.
+    When the client does not give the language, the language detected with a probability of at least pin_lang is pinned: the next requests of the
+    session skip the detection (and can be batched), every redetect requests (0 for never) the detection runs again and a confident one replaces the pinned language.
+    """
+    def __init__(self, timeout=300.0, pin_lang=None, redetect=0):
+        self.timeout = timeout
+        self.pin_lang = pin_lang
+        self.redetect = redetect
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def open(self):
+        sid = uuid.uuid4().hex
+        now = time.time()
+        with self.lock:
+            for expired in [k for k,v in self.sessions.items() if now - v['used'] > self.timeout]:
+                logging.info('[server] session {} expired'.format(expired))
+                sessions_expired_total.inc()
+                del self.sessions[expired]
+            self.sessions[sid] = {'audio': AudioBuffer(), 'lock': threading.Lock(), 'used': now, 'lang': None, 'pinned': 0}
+        logging.info('[server] session {} opened ({} sessions)'.format(sid, len(self.sessions)))
+        return sid
+
+    def close(self, sid):
+        with self.lock:
+            found = self.sessions.pop(sid, None) is not None
+        logging.info('[server] session {} closed'.format(sid))
+        return found
+
+    def __call__(self, transcribe, sid, audio, r):
+        """
+        Appends the new samples (audio starts at the absolute position r['offset']), releases those before r['confirmed'] and transcribes the pending ones.
+        Requests of a client with several requests in flight may arrive out of order: one confirming less than already released is transcribed from
+        the released position, returned in out['start'] (the word times are relative to it).
+        Returns None if the session does not exist.
+        """
+        with self.lock:
+            s = self.sessions.get(sid)
+        if s is None:
+            return None
+        with s['lock']:
+            s['used'] = time.time()
+            buffer = s['audio']
+            offset = int(r.get('offset', len(buffer)))
+            confirmed = int(r.get('confirmed', buffer.offset))
+            if confirmed >= len(buffer): ### nothing pending (new session, silence skipped by the client): the stream restarts at offset
+                buffer.release(len(buffer))
+                buffer.offset = max(buffer.offset, offset)
+            if offset > len(buffer):
+                raise ValueError('session {} holds samples [{}, {}) but received offset={} confirmed={}'.format(sid, buffer.offset, len(buffer), offset, confirmed))
+            buffer.append(audio[len(buffer)-offset:]) ### skip samples already received (retried requests)
+            confirmed = min(max(confirmed, buffer.offset), len(buffer))
+            buffer.release(confirmed)
+            out = transcribe(buffer[confirmed:], self.language(sid, s, r))
+            if r.get('lang') is None and self.pin_lang is not None and out['langP'] >= self.pin_lang and s['lang'] != out['lang']:
+                logging.info('[server] session {} language pinned to {} (p={:.2f})'.format(sid, out['lang'], out['langP']))
+                s['lang'] = out['lang']
+                s['pinned'] = 0
+            out['start'] = confirmed
+            out['end'] = len(buffer)
+        return out
+
+    def language(self, sid, s, r):
+        """ returns the request options with the pinned language of the session s (if any) when the client does not give one """
+        if r.get('lang') is not None:
+            lang_requests_total.inc(lang='client')
+            return r
+        if s['lang'] is None or (self.redetect > 0 and s['pinned'] >= self.redetect):
+            logging.debug('[server] session {} language detection'.format(sid))
+            lang_requests_total.inc(lang='detected')
+            s['pinned'] = 0
+            return r
+        lang_requests_total.inc(lang='pinned')
+        s['pinned'] += 1
+        return dict(r, lang=s['lang'])
+
     
 if __name__ == '__main__':
 
@@ -39,6 +222,17 @@ if __name__ == '__main__':
     group_model.add_argument('--compute', type=str, help='compute type: int8, float16, int8_float16', default='int8')
     group_model.add_argument('--device',  type=str, help='device: cpu, cuda, auto', default='auto')
     
+    group_batch = parser.add_argument_group("Batching")
+    group_batch.add_argument('--max_batch', type=int, help='maximum number of concurrent requests transcribed in a batch', default=8)
+    group_batch.add_argument('--max_wait', type=float, help='maximum time (seconds) waiting for concurrent requests to fill a batch', default=0.02)
+
+    group_session = parser.add_argument_group("Sessions")
+    group_session.add_argument('--session_timeout', type=float, help='close streaming sessions idle for more than this number of seconds', default=300.0)
+    group_session.add_argument('--pin_lang', type=float, help='pin the language of a session once detected with this probability (Ex: 0.9): next requests skip language detection, None to detect on every request', default=None)
+    group_session.add_argument('--redetect', type=int, help='run language detection again every this number of requests of a session with pinned language (0 for never)', default=0)
+
+    add_arguments(parser) ### serving and model workers
+
     group_other = parser.add_argument_group("Other")
     group_other.add_argument('--log', type=str, help='logging level: (verbose) debug, info, warning, error, critical (silent)', default='info')
     args = parser.parse_args()
@@ -46,13 +240,53 @@ if __name__ == '__main__':
     logging.basicConfig(format='[%(asctime)s.%(msecs)03d] %(levelname)s %(message)s', datefmt='%Y-%m-%d_%H:%M:%S', level=getattr(logging, 'INFO'), filename=None)
     logging.getLogger('faster_whisper').setLevel(logging.ERROR)    
 
-    w = WhisperModel(args.size, device=args.device, compute_type=args.compute)
+    tic = time.time()
+    w = WhisperModel(args.size, device=args.device, compute_type=args.compute, cpu_threads=args.intra_threads, num_workers=args.inter_threads)
+    model_load_seconds.set(time.time() - tic)
     logging.debug('[server] Loaded WhisperModel({}, {}, {})'.format(args.size, args.device, args.compute))
         
+    p = BatchedInferencePipeline(model=w) if BatchedInferencePipeline is not None and args.max_batch > 1 else None
+    batcher = Batcher(lambda key, items: run_batch(w, p, key, items), max_size=args.max_batch, max_wait=args.max_wait, workers=args.inter_threads, name='whisper')
+    def transcribe(audio, r):
+        return batcher(batch_key(r), [(audio, r)])[0]
+
+    sessions = Sessions(timeout=args.session_timeout, pin_lang=args.pin_lang, redetect=args.redetect)
+    Gauge('whisper_sessions', 'streaming sessions open', fn=lambda: len(sessions.sessions))
+
     app = Flask(__name__)
+    instrument(app, 'whisper') ### /metrics
     @app.route('/whisper', methods=['POST'])
     def send_data():
-        return jsonify(run(w, request.json))
+        try:
+            audio, r = read_request(request)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        return jsonify(transcribe(audio, r))
+
+    @app.route('/whisper/session', methods=['POST'])
+    def open_session():
+        return jsonify({'session': sessions.open()})
+
+    @app.route('/whisper/session/<sid>', methods=['POST'])
+    def send_session_data(sid):
+        try:
+            audio, r = read_request(request)
+            out = sessions(transcribe, sid, audio, r)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        if out is None:
+            return jsonify({'error': 'unknown session {}'.format(sid)}), 404
+        return jsonify(out)
+
+    @app.route('/whisper/session/<sid>', methods=['DELETE'])
+    def close_session(sid):
+        if not sessions.close(sid):
+            return jsonify({'error': 'unknown session {}'.format(sid)}), 404
+        return jsonify({'session': sid})
+
+    @app.route('/health', methods=['GET'])
+    def health():
+        return jsonify({'status': 'ok', 'sessions': len(sessions.sessions)})
     
-    app.run(host=args.host, port=args.port)
+    serve(app, args) ### concurrent requests are gathered by the batcher, whose batches run on inter_threads model workers
 